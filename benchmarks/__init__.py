@@ -0,0 +1,7 @@
+"""Benchmarks for indexing and serving queries.
+
+The benchmarks run on synthetic corpora, which makes it possible to
+assess how DONUT behaves for collections that are much larger than the
+current one. Use `python -m benchmarks.run` to run the benchmarks and
+`python -m benchmarks.compare` to compare the results of two runs.
+"""
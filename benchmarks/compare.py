@@ -0,0 +1,102 @@
+"""Compare results of two benchmark runs.
+
+This script reports the relative change of indexing throughput and
+route latencies between a baseline and a candidate run. If any of them
+got worse by more than the given tolerance, the script exits with a
+non-zero status, making it possible to detect regressions in CI.
+"""
+
+import argparse
+import json
+import sys
+
+
+def compare(baseline, candidate, tolerance=0.1):
+    """Compare results of two benchmark runs.
+
+    Parameters
+    ----------
+    baseline : dict
+        Results of the baseline run
+
+    candidate : dict
+        Results of the candidate run
+
+    tolerance : float
+        Relative change that is still acceptable
+
+    Returns
+    -------
+    list of tuples
+        (name, baseline, candidate, change, regression) tuples, where
+        the change is relative to the baseline and positive changes are
+        improvements.
+    """
+    rows = []
+
+    for name, result in candidate["indexing"].items():
+        if name not in baseline["indexing"]:
+            continue
+
+        old = baseline["indexing"][name]["entries_per_second"]
+        new = result["entries_per_second"]
+
+        if old and new:
+            change = new / old - 1
+            rows.append((name, old, new, change, change < -tolerance))
+
+    for route, passes in candidate["routes"].items():
+        for name, result in passes.items():
+            # Passes that are missing from the baseline, e.g. because it
+            # has been created before cold and warm passes were
+            # distinguished, cannot be compared.
+            if name not in baseline["routes"].get(route, {}):
+                continue
+
+            for statistic in ["p50", "p95", "p99"]:
+                old = baseline["routes"][route][name][statistic]
+                new = result[statistic]
+
+                # Lower latencies are better, so the sign is reversed.
+                change = 1 - new / old
+                rows.append(
+                    (
+                        f"{route} ({name}, {statistic})",
+                        old,
+                        new,
+                        change,
+                        change < -tolerance,
+                    )
+                )
+
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("baseline", help="Results of baseline run")
+    parser.add_argument("candidate", help="Results of candidate run")
+    parser.add_argument(
+        "-t",
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="Relative change that is still acceptable",
+    )
+
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+
+    rows = compare(baseline, candidate, args.tolerance)
+
+    for name, old, new, change, regression in rows:
+        marker = "!" if regression else " "
+        print(f"{marker} {name:30} {old:10.2f} {new:10.2f} {change:+8.1%}")
+
+    if any(row[-1] for row in rows):
+        sys.exit(1)
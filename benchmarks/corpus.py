@@ -0,0 +1,237 @@
+"""Generate synthetic corpora of BibTeX entries.
+
+The generated entries mimic the entries exported from Zotero: authors
+may have accented names, abstracts consist of several sentences, and
+keywords follow the `1 - foo:bar` format for tags and the `C - url`
+format for community resources. Every entry is written to a separate
+file, such that the corpus can be used as a data directory.
+"""
+
+import argparse
+import os
+import random
+
+FIRST_NAMES = [
+    "Ana",
+    "Bastian",
+    "Barbara",
+    "Chao",
+    "Émilie",
+    "Frédéric",
+    "Jānis",
+    "Jürgen",
+    "Mayank",
+    "Nuño",
+    "Søren",
+    "Vanessa",
+    "Yikai",
+    "Zoë",
+]
+
+LAST_NAMES = [
+    "Adams",
+    "Bubenik",
+    "Carlsson",
+    "Chazal",
+    "Edelsbrunner",
+    "Giunti",
+    "Lazovskis",
+    "Müller",
+    "Ødegård",
+    "Rieck",
+    "Robins",
+    "Şahin",
+    "Wagner",
+    "Zheng",
+]
+
+WORDS = [
+    "analysis",
+    "barcodes",
+    "complexes",
+    "detection",
+    "filtrations",
+    "graphs",
+    "homology",
+    "images",
+    "landscapes",
+    "learning",
+    "manifolds",
+    "networks",
+    "persistence",
+    "proteins",
+    "signals",
+    "stability",
+    "topological",
+    "vectorisation",
+]
+
+APPLICATIONS = [
+    "Biology",
+    "Biology:Proteins",
+    "Chemistry",
+    "Machine learning",
+    "Machine learning:Deep learning",
+    "Neuroscience",
+    "Physics:Cosmology",
+    "Signal processing",
+]
+
+TOOLS = [
+    "Mapper",
+    "Persistent homology",
+    "Persistent homology:Rips",
+    "Persistent homology:Rips:Sparse",
+    "Persistence landscapes",
+    "Euler characteristic",
+]
+
+DATA = [
+    "Graphs",
+    "Images:2D",
+    "Images:3D",
+    "Point cloud",
+    "Point cloud:High Dimension",
+    "Time series",
+]
+
+TYPES = ["article"] * 8 + ["inproceedings", "misc", "software"]
+
+FLAVOURS = ["innovate", "confirm"]
+
+
+def _sentence(rng, n_words):
+    """Return random sentence."""
+    words = rng.choices(WORDS, k=n_words)
+    return " ".join(words).capitalize() + "."
+
+
+def make_entry(rng, index):
+    """Create a random BibTeX entry.
+
+    Parameters
+    ----------
+    rng : random.Random
+        Random number generator
+
+    index : int
+        Index of the entry, which is used to make its key unique
+
+    Returns
+    -------
+    tuple of str
+        Key and BibTeX string of the entry
+    """
+    authors = [
+        f"{rng.choice(LAST_NAMES)}, {rng.choice(FIRST_NAMES)}"
+        for _ in range(rng.randint(1, 5))
+    ]
+
+    title = _sentence(rng, rng.randint(3, 8))[:-1]
+    abstract = " ".join(
+        _sentence(rng, rng.randint(8, 20)) for _ in range(rng.randint(3, 8))
+    )
+
+    year = rng.randint(2005, 2025)
+    month = rng.randint(1, 12)
+    day = rng.randint(1, 28)
+
+    keywords = [
+        f"1 - {tag}" for tag in rng.sample(APPLICATIONS, rng.randint(1, 3))
+    ]
+    keywords += [f"2 - {tag}" for tag in rng.sample(TOOLS, rng.randint(1, 2))]
+    keywords += [f"3 - {tag}" for tag in rng.sample(DATA, rng.randint(0, 2))]
+    keywords.append(rng.choice(FLAVOURS))
+
+    if rng.random() < 0.2:
+        keywords.append(f"C - https://github.com/donut/code-{index}")
+
+    if rng.random() < 0.05:
+        keywords.append(f"V - https://youtu.be/{index:011d} Talk")
+
+    key = "{}_{}_{}_{}".format(
+        authors[0].split(",")[0].lower(),
+        title.split()[0].lower(),
+        year,
+        index,
+    )
+
+    fields = {
+        "abstract": abstract,
+        "author": " and ".join(authors),
+        "date": f"{year}-{month:02d}-{day:02d}",
+        "doi": f"10.5555/donut.{index}",
+        "journaltitle": "Journal of " + rng.choice(WORDS).title(),
+        "keywords": ", ".join(keywords),
+        "title": title,
+        "url": f"https://example.org/papers/{index}",
+    }
+
+    lines = [f"@{rng.choice(TYPES)}{{{key},"]
+    lines += [f" {name} = {{{value}}}," for name, value in fields.items()]
+    lines[-1] = lines[-1][:-1]
+    lines.append("}")
+
+    return key, "\n".join(lines) + "\n"
+
+
+def generate_corpus(directory, n_entries, seed=42):
+    """Generate corpus of synthetic entries.
+
+    Parameters
+    ----------
+    directory : str
+        Directory to store the `.bib` files in; will be created if it
+        does not exist
+
+    n_entries : int
+        Number of entries to generate
+
+    seed : int
+        Seed of the random number generator; the same seed always
+        results in the same corpus.
+
+    Returns
+    -------
+    list of str
+        Filenames of the generated files, in sorted order
+    """
+    os.makedirs(directory, exist_ok=True)
+
+    rng = random.Random(seed)
+    filenames = []
+
+    for index in range(n_entries):
+        key, entry = make_entry(rng, index)
+        filename = os.path.join(directory, key + ".bib")
+
+        with open(filename, "w", encoding="utf-8") as f:
+            f.write(entry)
+
+        filenames.append(filename)
+
+    return sorted(filenames)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("directory", help="Output directory")
+    parser.add_argument(
+        "-n",
+        "--size",
+        type=int,
+        default=600,
+        help="Number of entries to generate",
+    )
+    parser.add_argument(
+        "-s",
+        "--seed",
+        type=int,
+        default=42,
+        help="Seed of the random number generator",
+    )
+
+    args = parser.parse_args()
+
+    filenames = generate_corpus(args.directory, args.size, args.seed)
+    print(f"Generated {len(filenames)} entries in {args.directory}")
@@ -0,0 +1,387 @@
+"""Run benchmarks on a synthetic corpus.
+
+This script generates a corpus of the given size, indexes it, and
+measures the throughput of indexing as well as the latency of the most
+important routes of the application, using the test client of Flask.
+Results are stored as JSON, such that different runs can be compared;
+see `benchmarks.compare`.
+
+Every route is measured twice with the same requests. The cold pass
+disables all caches and clears the per-revision caches of the database
+before every request, whereas the warm pass requests every URL once
+before measuring, so that repeated requests are served from caches.
+"""
+
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import donut
+
+from donut.database import get_handle
+from donut.database import index_documents
+
+from donut.reindex import reindex
+
+from benchmarks.corpus import WORDS
+from benchmarks.corpus import generate_corpus
+
+# Routes to measure; every route is requested with a number of different
+# parameters, which are generated by the respective function.
+ROUTES = {
+    "/": lambda rng, n: f"/?q={rng.choice(WORDS)}",
+    "/papers": lambda rng, n: "/papers",
+    "/software": lambda rng, n: "/software",
+    "/tags": lambda rng, n: "/tags",
+    "/random": lambda rng, n: "/random",
+    "/export/<id>": lambda rng, n: f"/export/{rng.randint(1, n)}",
+    "/export/all": lambda rng, n: "/export/all",
+    "/export?q=": lambda rng, n: f"/export?q={rng.choice(WORDS)}",
+}
+
+# Routes that export large parts of the corpus; they are requested less
+# often to keep the duration of a run manageable.
+BULK_ROUTES = ["/export/all", "/export?q="]
+BULK_REQUESTS = 10
+
+
+def _measure(function, *args, **kwargs):
+    """Call function and return its result and duration in seconds."""
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+
+    return result, time.perf_counter() - start
+
+
+def _throughput(n_entries, duration):
+    """Summarise throughput of an indexing run."""
+    return {
+        "entries": n_entries,
+        "duration": duration,
+        "entries_per_second": n_entries / duration if duration else None,
+    }
+
+
+def benchmark_indexing(filenames, work_dir, n_jobs=None):
+    """Measure throughput of indexing.
+
+    Parameters
+    ----------
+    filenames : list of str
+        Files of the corpus
+
+    work_dir : str
+        Directory for storing databases
+
+    n_jobs : int or None
+        Number of processes for parsing; see :func:`donut.reindex.reindex`
+
+    Returns
+    -------
+    tuple
+        Directory of the database created by a full reindex, which can
+        be used for further benchmarks, and a dict of results.
+    """
+    results = {}
+
+    # All entries in a single file; this is the input format expected
+    # by `index_documents`.
+    corpus_filename = os.path.join(work_dir, "corpus.bib")
+    with open(corpus_filename, "w", encoding="utf-8") as out:
+        for filename in filenames:
+            with open(filename, encoding="utf-8") as f:
+                out.write(f.read() + "\n")
+
+    _, duration = _measure(
+        index_documents, corpus_filename, os.path.join(work_dir, "single")
+    )
+    results["index_documents"] = _throughput(len(filenames), duration)
+
+    database_dir = os.path.join(work_dir, "database")
+
+    summary, duration = _measure(
+        reindex, filenames, database_dir, n_jobs, True
+    )
+    results["reindex_full"] = _throughput(len(summary["added"]), duration)
+
+    summary, duration = _measure(reindex, filenames, database_dir, n_jobs)
+    results["reindex_unchanged"] = _throughput(len(filenames), duration)
+
+    # Change one percent of the files to simulate a typical update.
+    changed = filenames[:: max(1, len(filenames) // 100)]
+    for filename in changed:
+        with open(filename, "a", encoding="utf-8") as f:
+            f.write("\n")
+
+    summary, duration = _measure(reindex, filenames, database_dir, n_jobs)
+    results["reindex_incremental"] = _throughput(
+        len(summary["updated"]), duration
+    )
+
+    return database_dir, results
+
+
+def _percentiles(latencies):
+    """Summarise latencies in milliseconds."""
+    latencies = [1000 * latency for latency in latencies]
+    quantiles = statistics.quantiles(latencies, n=100, method="inclusive")
+
+    return {
+        "requests": len(latencies),
+        "mean": statistics.mean(latencies),
+        "p50": quantiles[49],
+        "p95": quantiles[94],
+        "p99": quantiles[98],
+    }
+
+
+def _request(client, url):
+    """Request URL, consuming the full response."""
+    response = client.get(url)
+
+    # Streamed responses are only generated while being consumed.
+    response.get_data()
+
+    return response
+
+
+@contextlib.contextmanager
+def _disabled_caches():
+    """Disable caches of rendered results and search results."""
+    settings = (
+        donut.FRAGMENT_CACHE_SIZE,
+        donut.QUERY_CACHE_SIZE,
+        donut.QUERY_CACHE_FILE,
+    )
+
+    donut.FRAGMENT_CACHE_SIZE = 0
+    donut.QUERY_CACHE_SIZE = 0
+    donut.QUERY_CACHE_FILE = None
+
+    try:
+        yield
+    finally:
+        (
+            donut.FRAGMENT_CACHE_SIZE,
+            donut.QUERY_CACHE_SIZE,
+            donut.QUERY_CACHE_FILE,
+        ) = settings
+
+
+def _measure_urls(client, urls, before=None):
+    """Request URLs and return statistics of their latencies.
+
+    If set, `before` is called prior to every request, without being
+    included in the latency.
+    """
+    latencies = []
+
+    for url in urls:
+        if before is not None:
+            before()
+
+        response, duration = _measure(_request, client, url)
+
+        if response.status_code != 200:
+            raise RuntimeError(
+                f"Request to {url} failed with {response.status}"
+            )
+
+        latencies.append(duration)
+
+    return _percentiles(latencies)
+
+
+def benchmark_routes(
+    database_dir, n_entries, n_requests=100, seed=42, caching=True
+):
+    """Measure latency of routes.
+
+    Parameters
+    ----------
+    database_dir : str
+        Directory of database
+
+    n_entries : int
+        Number of entries in the database
+
+    n_requests : int
+        Number of requests per route; bulk routes are requested at most
+        `BULK_REQUESTS` times.
+
+    seed : int
+        Seed for generating request parameters
+
+    caching : bool
+        If not set, caches are disabled for the warm pass as well.
+
+    Returns
+    -------
+    dict
+        Latency statistics in milliseconds for every route, with
+        separate statistics for the `cold` and the `warm` pass
+    """
+    # Routes look up the database directory at request time, so we can
+    # point the application to the benchmark database.
+    donut.DATABASE_DIR = database_dir
+
+    rng = random.Random(seed)
+    urls = {}
+
+    for route, make_url in ROUTES.items():
+        n = n_requests
+        if route in BULK_ROUTES:
+            n = min(n_requests, BULK_REQUESTS)
+
+        urls[route] = [make_url(rng, n_entries) for _ in range(n)]
+
+    def _clear():
+        get_handle(database_dir).cache.clear()
+
+    with _disabled_caches():
+        client = donut.create().test_client()
+        cold = {
+            route: _measure_urls(client, urls[route], _clear)
+            for route in ROUTES
+        }
+
+    with contextlib.ExitStack() as stack:
+        if not caching:
+            stack.enter_context(_disabled_caches())
+
+        client = donut.create().test_client()
+
+        for route in ROUTES:
+            for url in set(urls[route]):
+                _request(client, url)
+
+        warm = {
+            route: _measure_urls(client, urls[route]) for route in ROUTES
+        }
+
+    return {
+        route: {"cold": cold[route], "warm": warm[route]} for route in ROUTES
+    }
+
+
+def run(n_entries, n_requests=100, seed=42, n_jobs=None, caching=True):
+    """Run all benchmarks and return their results."""
+    work_dir = tempfile.mkdtemp(prefix="donut-benchmark-")
+
+    try:
+        filenames = generate_corpus(
+            os.path.join(work_dir, "data"), n_entries, seed
+        )
+
+        database_dir, indexing = benchmark_indexing(
+            filenames, work_dir, n_jobs
+        )
+
+        routes = benchmark_routes(
+            database_dir, n_entries, n_requests, seed, caching
+        )
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    try:
+        revision = donut.get_git_revision()
+    except (OSError, subprocess.CalledProcessError):
+        revision = "unknown"
+
+    return {
+        "metadata": {
+            "entries": n_entries,
+            "requests": n_requests,
+            "seed": seed,
+            "caching": caching,
+            "revision": revision,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "date": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        },
+        "indexing": indexing,
+        "routes": routes,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "-n",
+        "--size",
+        type=int,
+        default=600,
+        help="Number of entries of the corpus",
+    )
+    parser.add_argument(
+        "-r",
+        "--requests",
+        type=int,
+        default=100,
+        help="Number of requests per route",
+    )
+    parser.add_argument(
+        "-s",
+        "--seed",
+        type=int,
+        default=42,
+        help="Seed of the random number generator",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=None,
+        help="Number of parsing processes (default: number of processors)",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Disable caches of rendered results and search results "
+        "in the warm pass as well",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=str,
+        default=None,
+        help="File to store results in (default: standard output)",
+    )
+
+    args = parser.parse_args()
+
+    results = run(
+        args.size, args.requests, args.seed, args.jobs, not args.no_cache
+    )
+
+    if args.output is None:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    for name, result in results["indexing"].items():
+        print(
+            f"{name}: {result['duration']:.2f}s "
+            f"({result['entries_per_second'] or 0:.1f} entries/s)",
+            file=sys.stderr,
+        )
+
+    for route, passes in results["routes"].items():
+        for name, result in passes.items():
+            print(
+                f"{route} ({name}): p50={result['p50']:.1f}ms "
+                f"p95={result['p95']:.1f}ms p99={result['p99']:.1f}ms",
+                file=sys.stderr,
+            )
@@ -0,0 +1,172 @@
+"""Check that bulk exports scale linearly with the size of the corpus.
+
+This script indexes synthetic corpora of increasing size and measures
+the time of exporting all documents as well as all matches of a query.
+The time per exported entry must not grow with the size of the corpus;
+if it grows by more than the given factor between the smallest and the
+largest corpus, the script exits with a non-zero status.
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+
+import donut
+
+from donut.reindex import reindex
+
+from benchmarks.corpus import generate_corpus
+from benchmarks.run import _measure
+from benchmarks.run import _request
+
+# Bulk routes to measure. The query matches most documents of the
+# synthetic corpus, since every abstract consists of the same words.
+ROUTES = ["/export/all", "/export?q=homology"]
+
+
+def measure_export(n_entries, work_dir, n_repeats=3, seed=42):
+    """Measure duration of bulk exports for a corpus of a given size.
+
+    Parameters
+    ----------
+    n_entries : int
+        Number of entries of the corpus
+
+    work_dir : str
+        Directory for storing the corpus and the database
+
+    n_repeats : int
+        Number of requests per route; the fastest one is reported.
+
+    seed : int
+        Seed for generating the corpus
+
+    Returns
+    -------
+    dict
+        Duration in seconds for every route
+    """
+    directory = os.path.join(work_dir, str(n_entries))
+
+    filenames = generate_corpus(
+        os.path.join(directory, "data"), n_entries, seed
+    )
+
+    database_dir = os.path.join(directory, "database")
+    reindex(filenames, database_dir, full=True)
+
+    donut.DATABASE_DIR = database_dir
+    client = donut.create().test_client()
+
+    results = {}
+
+    for route in ROUTES:
+        durations = []
+
+        for _ in range(n_repeats):
+            response, duration = _measure(_request, client, route)
+
+            if response.status_code != 200:
+                raise RuntimeError(
+                    f"Request to {route} failed with {response.status}"
+                )
+
+            durations.append(duration)
+
+        results[route] = min(durations)
+
+    return results
+
+
+def check_scaling(sizes, tolerance=2.0, n_repeats=3, seed=42):
+    """Check that the duration of exports grows linearly.
+
+    Parameters
+    ----------
+    sizes : list of int
+        Sizes of the corpora, in increasing order
+
+    tolerance : float
+        Maximum factor by which the duration per entry may grow
+        between the smallest and the largest corpus
+
+    n_repeats : int
+        Number of requests per route and size
+
+    seed : int
+        Seed for generating the corpora
+
+    Returns
+    -------
+    tuple
+        List of (route, size, duration, duration per entry) tuples, and
+        list of routes that do not scale linearly
+    """
+    work_dir = tempfile.mkdtemp(prefix="donut-scaling-")
+    rows = []
+
+    try:
+        for size in sizes:
+            durations = measure_export(size, work_dir, n_repeats, seed)
+
+            for route, duration in durations.items():
+                rows.append((route, size, duration, duration / size))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    failures = []
+
+    for route in ROUTES:
+        per_entry = [row[3] for row in rows if row[0] == route]
+
+        if per_entry[-1] > tolerance * per_entry[0]:
+            failures.append(route)
+
+    return rows, failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "-n",
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[1000, 4000, 16000],
+        help="Sizes of the corpora",
+    )
+    parser.add_argument(
+        "-t",
+        "--tolerance",
+        type=float,
+        default=2.0,
+        help="Maximum growth of the duration per entry",
+    )
+    parser.add_argument(
+        "-r",
+        "--repeats",
+        type=int,
+        default=3,
+        help="Number of requests per route and size",
+    )
+
+    args = parser.parse_args()
+
+    rows, failures = check_scaling(
+        sorted(args.sizes), args.tolerance, args.repeats
+    )
+
+    for route, size, duration, per_entry in rows:
+        print(
+            f"{route:20} {size:8d} {duration:8.3f}s "
+            f"{1e6 * per_entry:8.1f}us/entry"
+        )
+
+    if failures:
+        print(
+            f"Exports do not scale linearly: {', '.join(failures)}",
+            file=sys.stderr,
+        )
+        sys.exit(1)
@@ -1,29 +1,59 @@
 """Main Flask module."""
 
 import datetime
+import functools
+import hashlib
 import io
+import json
 import os
 import subprocess
+import time
 
 from dotenv import load_dotenv
 
-from bibtexparser.bwriter import BibTexWriter
-from bibtexparser.bibdatabase import BibDatabase
-
+from flask import abort
 from flask import Flask
-from flask import render_template
+from flask import g
+from flask import jsonify
+from flask import make_response
+from flask import render_template as _render_template
 from flask import request
 from flask import send_file
+from flask import stream_with_context
+
+from markupsafe import Markup
+
+from donut.cache import LRUCache
+
+from donut.completion import complete
+from donut.completion import MAX_COMPLETIONS
 
+from donut.database import configure_query_cache
+from donut.database import get_query_cache_stats
 from donut.database import get_document
 from donut.database import get_documents
+from donut.database import get_last_modified
 from donut.database import get_num_documents
 from donut.database import get_random_document
-from donut.database import get_tags
+from donut.database import get_related
+from donut.database import get_revision
+from donut.database import get_tag_hierarchy
+from donut.database import get_version
+from donut.database import iter_documents
+from donut.database import iter_search
 from donut.database import search
-
-from donut.utils import flat_tags_to_hierarchy
-
+from donut.database import PAGE_SIZE
+from donut.database import SORT_ORDERS
+
+from donut.metrics import format_metric
+from donut.metrics import format_server_timing
+from donut.metrics import MATCHES
+from donut.metrics import PHASE_LATENCY
+from donut.metrics import REQUEST_LATENCY
+from donut.metrics import start_request
+from donut.metrics import timed
+
+from xapian import DocNotFoundError
 from xapian import QueryParserError
 
 # Make sure that we have access to the database directory and other
@@ -31,6 +61,27 @@ from xapian import QueryParserError
 load_dotenv()
 DATABASE_DIR = os.getenv("DATABASE_DIR", "database")
 
+# Upper bound for the number of matches shown on a single page.
+MAX_PAGE_SIZE = 100
+
+# Maximum number of rendered results to cache. The default is large
+# enough to keep the whole list of papers in the cache.
+FRAGMENT_CACHE_SIZE = int(os.getenv("FRAGMENT_CACHE_SIZE", 2048))
+
+# Maximum number of search results to cache. If a file is specified, the
+# results will also be shared between all workers.
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", 1024))
+QUERY_CACHE_FILE = os.getenv("QUERY_CACHE_FILE")
+
+# Number of seconds for which clients and proxies may reuse responses
+# without revalidating them.
+CACHE_MAX_AGE = int(os.getenv("CACHE_MAX_AGE", 60))
+
+# Rendering templates is measured as a phase of every request. Nested
+# calls, such as for rendering result fragments, count towards the outer
+# call.
+render_template = timed("render")(_render_template)
+
 
 def get_git_revision():
     """Return git short revision string."""
@@ -41,14 +92,159 @@ def get_git_revision():
     )
 
 
+def get_git_timestamp():
+    """Return commit time of the git revision as a `datetime`."""
+    timestamp = subprocess.check_output(
+        ["git", "log", "-1", "--format=%ct", "HEAD"]
+    )
+
+    return datetime.datetime.fromtimestamp(
+        int(timestamp.decode("ascii").strip()), datetime.timezone.utc
+    )
+
+
 def create(test_config=None):
     """Create main application."""
     app = Flask(__name__)
-    app.jinja_env.globals.update(get_git_revision=get_git_revision)
+
+    configure_query_cache(QUERY_CACHE_SIZE, QUERY_CACHE_FILE)
+
+    # The build only changes when the application is deployed again, so
+    # we query it only once.
+    try:
+        build_id = get_git_revision()
+    except (OSError, subprocess.CalledProcessError):
+        build_id = "unknown"
+
+    # The time of the build must be the same for all workers, so that
+    # they report the same modification time for the same response.
+    try:
+        built = get_git_timestamp()
+    except (OSError, subprocess.CalledProcessError, ValueError):
+        built = None
+
+    app.jinja_env.globals.update(build_id=build_id)
     app.jinja_env.trim_blocks = True
     app.jinja_env.lstrip_blocks = True
 
+    fragments = LRUCache(FRAGMENT_CACHE_SIZE)
+    fragments_template = None
+
+    def render_result(match):
+        """Render single result, reusing previously-rendered fragments.
+
+        Fragments are valid for a single version of the database. If
+        the template of a result changes, it will be reloaded and all
+        fragments have to be rendered again.
+        """
+        nonlocal fragments_template
+
+        template = app.jinja_env.get_template("result.html")
+        if template is not fragments_template:
+            fragments.clear()
+            fragments_template = template
+
+        if "version" not in g:
+            g.version = get_version(DATABASE_DIR)
+
+        key = (match["id"], g.version, request.script_root)
+        fragment = fragments.get(key)
+
+        if fragment is None:
+            fragment = Markup(render_template(template, d=match))
+            fragments.set(key, fragment)
+
+        return fragment
+
+    app.jinja_env.globals.update(render_result=render_result)
+
+    @app.before_request
+    def start_timing():
+        g.start = time.perf_counter()
+        g.timings = start_request()
+
+    @app.after_request
+    def finish_timing(response):
+        """Report phases of request and record its latency.
+
+        Streamed responses are only generated after this function has
+        been called, so their `Server-Timing` header only covers setting
+        up the response. Their latency and phases are recorded once the
+        response has been closed, i.e. including the generated body.
+        """
+        start, timings = g.start, g.timings
+
+        header = dict(timings)
+        header["total"] = time.perf_counter() - start
+        response.headers["Server-Timing"] = format_server_timing(header)
+
+        route = request.url_rule.rule if request.url_rule else "unknown"
+        method = request.method
+
+        @response.call_on_close
+        def record_timing():
+            duration = time.perf_counter() - start
+
+            for phase, phase_duration in timings.items():
+                PHASE_LATENCY.observe(phase_duration, phase)
+
+            REQUEST_LATENCY.observe(duration, route, method)
+
+        return response
+
+    def conditional(view):
+        """Support conditional requests for a view.
+
+        Responses only depend on the request, the database, and the
+        build of the application. Their entity tag is thus derived from
+        these values, making it possible to answer repeated requests
+        with "304 Not Modified" without calling the view at all.
+        """
+
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method not in ("GET", "HEAD"):
+                return view(*args, **kwargs)
+
+            etag = ":".join(
+                [build_id, get_version(DATABASE_DIR), request.full_path]
+            )
+            etag = hashlib.sha1(etag.encode()).hexdigest()
+
+            # A new build may change all responses, so responses cannot
+            # be older than the build.
+            last_modified = [get_last_modified(DATABASE_DIR), built]
+            last_modified = max(
+                (t for t in last_modified if t is not None), default=None
+            )
+
+            # Proxies that compress responses, such as `nginx`, turn the
+            # entity tag into a weak one.
+            if request.if_none_match:
+                not_modified = request.if_none_match.contains_weak(etag)
+            else:
+                not_modified = (
+                    last_modified is not None
+                    and request.if_modified_since is not None
+                    and request.if_modified_since >= last_modified
+                )
+
+            if not_modified:
+                response = app.response_class(status=304)
+            else:
+                response = make_response(view(*args, **kwargs))
+
+            response.set_etag(etag)
+            response.last_modified = last_modified
+            response.cache_control.public = True
+            response.cache_control.max_age = CACHE_MAX_AGE
+
+            return response
+
+        return wrapper
+
     @app.route("/", methods=["GET", "POST"])
+    @conditional
     def index():
         num_documents = get_num_documents(DATABASE_DIR)
         start = datetime.datetime.now()
@@ -58,8 +254,20 @@ def create(test_config=None):
         else:
             query = request.args.get("q", "")
 
+        offset = request.values.get("offset", 0, type=int)
+        offset = max(offset, 0)
+
+        # Clamp the page size so that clients cannot request the whole
+        # database in one go.
+        pagesize = request.values.get("pagesize", PAGE_SIZE, type=int)
+        pagesize = min(max(pagesize, 1), MAX_PAGE_SIZE)
+
+        sort = request.values.get("sort", "relevance")
+        if sort not in SORT_ORDERS:
+            sort = "relevance"
+
         try:
-            matches = search(DATABASE_DIR, query)
+            matches = search(DATABASE_DIR, query, offset, pagesize, sort)
         except QueryParserError:
             return render_template("error.html", query=query)
 
@@ -74,21 +282,21 @@ def create(test_config=None):
             data=matches[0] if matches else None,
             query=query,
             suggestion=matches[1] if matches else "",
+            num_matches=matches[2] if matches else 0,
+            facets=matches[3] if matches else None,
             num_documents=num_documents,
             duration=duration,
+            offset=offset,
+            pagesize=pagesize,
+            sort=sort,
         )
 
     @app.route("/papers")
+    @conditional
     def papers():
         start = datetime.datetime.now()
 
-        matches = get_documents(DATABASE_DIR)
-
-        matches = [
-            m
-            for m in matches
-            if m["document"]["raw"]["ENTRYTYPE"] != "software"
-        ]
+        matches = get_documents(DATABASE_DIR, exclude_types=["software"])
 
         duration = datetime.datetime.now() - start
         duration = duration.total_seconds()
@@ -100,16 +308,11 @@ def create(test_config=None):
         )
 
     @app.route("/software")
+    @conditional
     def software():
         start = datetime.datetime.now()
 
-        matches = get_documents(DATABASE_DIR)
-
-        matches = [
-            m
-            for m in matches
-            if m["document"]["raw"]["ENTRYTYPE"] == "software"
-        ]
+        matches = get_documents(DATABASE_DIR, include_types=["software"])
 
         duration = datetime.datetime.now() - start
         duration = duration.total_seconds()
@@ -120,47 +323,61 @@ def create(test_config=None):
             duration=duration,
         )
 
-    @app.route("/random", methods=["POST"])
+    @app.route("/random", methods=["GET", "POST"])
     def random():
-        matches = [get_random_document(DATABASE_DIR)]
+        entry_type = request.values.get("type")
+        tag = request.values.get("tag")
+
+        # Papers are all documents that are not software; this mirrors
+        # the filter of the respective page.
+        if entry_type == "paper":
+            include_types, exclude_types = None, ["software"]
+        elif entry_type:
+            include_types, exclude_types = [entry_type], None
+        else:
+            include_types, exclude_types = None, None
+
+        match = get_random_document(
+            DATABASE_DIR, include_types, exclude_types, tag
+        )
+
+        matches = [match] if match is not None else []
         return render_template("index.html", data=matches, duration=None)
 
+    @app.route("/complete")
+    @conditional
+    def completions():
+        query = request.args.get("q", "")
+
+        k = request.args.get("k", MAX_COMPLETIONS, type=int)
+        k = min(max(k, 1), MAX_COMPLETIONS)
+
+        return jsonify(complete(DATABASE_DIR, query, k))
+
     @app.route("/faq")
+    @conditional
     def faq():
         return render_template("faq.html")
 
     @app.route("/contributors")
+    @conditional
     def contributors():
         return render_template("contributors.html")
 
     @app.route("/tags")
+    @conditional
     def tags():
-        tags = get_tags(DATABASE_DIR)
-
-        tags = {
-            category: sorted(keywords.items())
-            for category, keywords in sorted(tags.items())
-        }
-
-        tags = flat_tags_to_hierarchy(tags)
+        tags = get_tag_hierarchy(DATABASE_DIR)
         return render_template("tags.html", tags=tags)
 
     @app.route("/export/<int:identifier>")
+    @conditional
     def export(identifier):
-        document = get_document(DATABASE_DIR, identifier)
-
-        # Prepare document for export by renaming some of the keys. Not
-        # a big fan of this, but it's easier than storing everything.
+        document = get_document(DATABASE_DIR, identifier, bibtex=True)
+        document = document["document"]
 
-        db = BibDatabase()
-        db.entries = [document["document"]["raw"]]
-
-        writer = BibTexWriter()
-        buffer = io.BytesIO()
-        buffer.write(writer.write(db).encode())
-        buffer.seek(0)
-
-        name = document["document"]["raw"]["ID"] + ".bib"
+        buffer = io.BytesIO(document["bibtex"].encode())
+        name = document["id"] + ".bib"
 
         return send_file(
             buffer,
@@ -169,4 +386,194 @@ def create(test_config=None):
             mimetype="application/x-bibtex",
         )
 
+    @app.route("/metrics")
+    def metrics():
+        lines = []
+
+        # Every worker only reports its own values; see the README.
+        worker = [("worker", os.getpid())]
+
+        for histogram in [REQUEST_LATENCY, PHASE_LATENCY, MATCHES]:
+            lines.extend(histogram.collect(worker))
+
+        lines.extend(
+            format_metric(
+                "donut_index_revision",
+                "Revision of the database",
+                "gauge",
+                get_revision(DATABASE_DIR),
+                worker,
+            )
+        )
+        lines.extend(
+            format_metric(
+                "donut_index_documents",
+                "Number of documents in the database",
+                "gauge",
+                get_num_documents(DATABASE_DIR),
+                worker,
+            )
+        )
+
+        caches = {
+            "query": get_query_cache_stats(),
+            "fragment": {"hits": fragments.hits, "misses": fragments.misses},
+        }
+
+        for name, stats in caches.items():
+            for result, count in stats.items():
+                lines.extend(
+                    format_metric(
+                        f"donut_{name}_cache_{result}_total",
+                        f"Number of {result} of the {name} cache",
+                        "counter",
+                        count,
+                        worker,
+                    )
+                )
+
+        response = app.response_class("\n".join(lines) + "\n")
+        response.content_type = "text/plain; version=0.0.4; charset=utf-8"
+
+        return response
+
+    @app.route("/related/<int:identifier>")
+    @conditional
+    def related(identifier):
+        try:
+            document = get_document(DATABASE_DIR, identifier)
+            related = get_related(DATABASE_DIR, identifier)
+        except DocNotFoundError:
+            abort(404)
+
+        return render_template(
+            "related.html", document=document, related=related
+        )
+
+    def _stream_bibtex(matches, name):
+        """Stream concatenated BibTeX entries of matches."""
+
+        def generate():
+            for index, match in enumerate(matches):
+                if index > 0:
+                    yield "\n"
+
+                yield match["document"]["bibtex"]
+
+        return app.response_class(
+            stream_with_context(generate()),
+            mimetype="application/x-bibtex",
+            headers={"Content-Disposition": f"attachment; filename={name}"},
+        )
+
+    @app.route("/export")
+    @conditional
+    def export_query():
+        query = request.args.get("q", "")
+
+        if not query:
+            abort(400)
+
+        try:
+            matches = iter_search(DATABASE_DIR, query, bibtex=True)
+        except QueryParserError:
+            return render_template("error.html", query=query)
+
+        return _stream_bibtex(matches, "donut.bib")
+
+    @app.route("/export/all")
+    @conditional
+    def export_all():
+        matches = iter_documents(DATABASE_DIR, bibtex=True)
+        return _stream_bibtex(matches, "donut.bib")
+
+    def _get_fields():
+        """Return fields requested by an API client or `None`."""
+        fields = request.args.get("fields")
+        return fields.split(",") if fields else None
+
+    def _to_record(match, fields):
+        """Convert match to record for API clients.
+
+        The record contains the document identifier, which is used for
+        exports, as well as the requested fields of the document.
+        """
+        document = match["document"]
+
+        record = {"docid": match["id"]}
+        record.update(
+            (key, value)
+            for key, value in document.items()
+            if key != "v" and (fields is None or key in fields)
+        )
+
+        return record
+
+    def _stream(matches, fields):
+        """Stream matches as newline-delimited JSON records."""
+
+        def generate():
+            for match in matches:
+                yield json.dumps(_to_record(match, fields)) + "\n"
+
+        return app.response_class(
+            stream_with_context(generate()),
+            mimetype="application/x-ndjson",
+        )
+
+    @app.route("/api/search")
+    @conditional
+    def api_search():
+        query = request.args.get("q", "")
+        fields = _get_fields()
+
+        sort = request.args.get("sort", "relevance")
+        if sort not in SORT_ORDERS:
+            abort(400)
+
+        try:
+            matches = iter_search(
+                DATABASE_DIR,
+                query,
+                offset=request.args.get("offset", 0, type=int),
+                limit=request.args.get("limit", None, type=int),
+                sort=sort,
+                raw=fields is not None and "raw" in fields,
+            )
+        except QueryParserError:
+            abort(400)
+
+        return _stream(matches, fields)
+
+    @app.route("/api/papers")
+    @conditional
+    def api_papers():
+        fields = _get_fields()
+
+        matches = iter_documents(
+            DATABASE_DIR,
+            exclude_types=["software"],
+            offset=request.args.get("offset", 0, type=int),
+            limit=request.args.get("limit", None, type=int),
+            raw=fields is not None and "raw" in fields,
+        )
+
+        return _stream(matches, fields)
+
+    @app.route("/api/documents/<int:identifier>")
+    @conditional
+    def api_document(identifier):
+        fields = _get_fields()
+
+        try:
+            document = get_document(
+                DATABASE_DIR,
+                identifier,
+                raw=fields is None or "raw" in fields,
+            )
+        except DocNotFoundError:
+            abort(404)
+
+        return jsonify(_to_record(document, fields))
+
     return app
@@ -1,7 +1,17 @@
-"""Analyse existing tags."""
+"""Analyse existing tags.
 
-import os
+This script reports pairs of tags that are likely to be near-duplicates
+based on their Jaro--Winkler similarity. By default, all pairs of tags
+within a category are compared. For large vocabularies, the vectorised
+mode first finds candidate pairs via nearest neighbours of character
+n-gram TF-IDF vectors, and only compares those.
+"""
+
+import argparse
 import itertools
+import json
+import os
+import sys
 
 from dotenv import load_dotenv
 
@@ -9,19 +19,171 @@ from donut.database import get_tags
 
 from nltk.metrics.distance import jaro_winkler_similarity
 
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.neighbors import NearestNeighbors
+
 load_dotenv()
 DATABASE_DIR = os.getenv("DATABASE_DIR", "database")
 
 
+def get_all_pairs(tags):
+    """Return all pairs of tags."""
+    return itertools.combinations(range(len(tags)), 2)
+
+
+def get_candidate_pairs(tags, n_neighbours=10):
+    """Return candidate pairs of similar tags.
+
+    Tags are represented by TF-IDF vectors of their character n-grams.
+    Only the nearest neighbours of each tag with respect to the cosine
+    distance of these vectors are considered as candidates.
+
+    Parameters
+    ----------
+    tags : list of str
+        Tags to compare
+
+    n_neighbours : int
+        Number of neighbours of each tag to consider
+
+    Returns
+    -------
+    set of tuples
+        Pairs of indices (i, j) with i < j
+    """
+    if len(tags) < 2:
+        return set()
+
+    vectorizer = TfidfVectorizer(analyzer="char_wb", ngram_range=(2, 3))
+    X = vectorizer.fit_transform(tags)
+
+    n_neighbours = min(n_neighbours + 1, len(tags))
+    neighbours = NearestNeighbors(n_neighbors=n_neighbours, metric="cosine")
+    neighbours.fit(X)
+
+    _, indices = neighbours.kneighbors(X)
+
+    return {
+        (min(i, j), max(i, j))
+        for i, row in enumerate(indices)
+        for j in row
+        if i != j
+    }
+
+
+def find_similar_tags(items, threshold=0.9, vectorised=False):
+    """Find pairs of similar tags.
+
+    Parameters
+    ----------
+    items : list of tuples
+        (category, tag) pairs to compare
+
+    threshold : float
+        Minimum Jaro--Winkler similarity of a pair to be reported
+
+    vectorised : bool
+        If set, only compares candidate pairs; see
+        :func:`get_candidate_pairs`.
+
+    Returns
+    -------
+    list of tuples
+        (item, item, similarity) triples, sorted by the items
+    """
+    tags = [tag for _, tag in items]
+
+    if vectorised:
+        pairs = get_candidate_pairs(tags)
+    else:
+        pairs = get_all_pairs(tags)
+
+    similar = []
+    for i, j in pairs:
+        similarity = jaro_winkler_similarity(tags[i], tags[j])
+        if similarity >= threshold:
+            similar.append((items[i], items[j], similarity))
+
+    return sorted(similar)
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "-v",
+        "--vectorised",
+        action="store_true",
+        help="Only compare candidate pairs of n-gram nearest neighbours",
+    )
+    parser.add_argument(
+        "-c",
+        "--cross-category",
+        action="store_true",
+        help="Compare tags across all categories",
+    )
+    parser.add_argument(
+        "-t",
+        "--threshold",
+        type=float,
+        default=0.9,
+        help="Minimum similarity of reported tags",
+    )
+    parser.add_argument(
+        "--json",
+        action="store_true",
+        help="Output results as JSON",
+    )
+    parser.add_argument(
+        "--strict",
+        action="store_true",
+        help="Exit with a non-zero status if similar tags are found",
+    )
+
+    args = parser.parse_args()
+
     tags = get_tags(DATABASE_DIR)
 
-    for category in sorted(tags.keys()):
-        tags_per_category = sorted(tags[category].keys())
+    if args.cross_category:
+        groups = {
+            None: [
+                (category, tag)
+                for category in sorted(tags.keys())
+                for tag in sorted(tags[category].keys())
+            ]
+        }
+    else:
+        groups = {
+            category: [(category, tag) for tag in sorted(tags[category])]
+            for category in sorted(tags.keys())
+        }
+
+    results = []
+
+    for category, items in groups.items():
+        similar = find_similar_tags(items, args.threshold, args.vectorised)
+
+        if not args.json:
+            if category is not None:
+                print("Category:", category)
+
+            for (c1, t1), (c2, t2), _ in similar:
+                if category is None:
+                    print("  ", f"{t1} ({c1})", "~", f"{t2} ({c2})")
+                else:
+                    print("  ", t1, "~", t2)
+
+        results.extend(
+            {
+                "tags": [t1, t2],
+                "categories": [c1, c2],
+                "similarity": similarity,
+            }
+            for (c1, t1), (c2, t2), similarity in similar
+        )
 
-        print("Category:", category)
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
 
-        for t1, t2 in itertools.combinations(tags_per_category, 2):
-            dist = jaro_winkler_similarity(t1, t2)
-            if dist >= 0.9:
-                print("  ", t1, "~", t2)
+    if args.strict and results:
+        sys.exit(1)
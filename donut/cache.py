@@ -0,0 +1,205 @@
+"""Caching utilities.
+
+Unless noted otherwise, the caches in this module are process-local.
+They are shared between all threads of a worker, so every operation is
+guarded by a lock.
+"""
+
+import collections
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class LRUCache:
+    """Bounded cache that evicts the least-recently-used items.
+
+    Parameters
+    ----------
+    maxsize : int
+        Maximum number of items to keep. A size of zero disables the
+        cache altogether.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        """Return cached item or a default value if it is missing."""
+        with self._lock:
+            try:
+                value = self._items[key]
+            except KeyError:
+                self.misses += 1
+                return default
+
+            self._items.move_to_end(key)
+            self.hits += 1
+
+            return value
+
+    def set(self, key, value):
+        """Store item, evicting the least-recently-used one if full."""
+        if self.maxsize <= 0:
+            return
+
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        """Remove all items."""
+        with self._lock:
+            self._items.clear()
+
+
+class SQLiteCache:
+    """Persistent cache backed by an SQLite database.
+
+    The cache is meant to be shared between multiple processes, such as
+    the workers of a web server, on the same machine. Keys and values
+    have to be serialisable to JSON. Once the cache grows beyond its
+    maximum size, the least-recently-stored items are removed.
+
+    Parameters
+    ----------
+    filename : str
+        File of SQLite database; will be created if it does not exist
+
+    maxsize : int
+        Maximum number of items to keep
+    """
+
+    def __init__(self, filename, maxsize):
+        self.filename = filename
+        self.maxsize = maxsize
+
+        # SQLite connections must not be shared between threads.
+        self._local = threading.local()
+
+        with self._connect() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache "
+                "(key TEXT PRIMARY KEY, value TEXT, stored REAL)"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS cache_stored ON cache (stored)"
+            )
+
+    def _connect(self):
+        """Return connection of the current thread and process."""
+        if getattr(self._local, "pid", None) != os.getpid():
+            self._local.connection = sqlite3.connect(
+                self.filename, timeout=1.0
+            )
+            self._local.pid = os.getpid()
+
+        return self._local.connection
+
+    def get(self, key, default=None):
+        """Return cached item or a default value if it is missing."""
+        try:
+            row = (
+                self._connect()
+                .execute(
+                    "SELECT value FROM cache WHERE key = ?",
+                    (json.dumps(key),),
+                )
+                .fetchone()
+            )
+        except sqlite3.Error:
+            return default
+
+        return default if row is None else json.loads(row[0])
+
+    def set(self, key, value):
+        """Store item, removing the oldest items if necessary."""
+        try:
+            with self._connect() as connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO cache VALUES (?, ?, ?)",
+                    (json.dumps(key), json.dumps(value), time.time()),
+                )
+                connection.execute(
+                    "DELETE FROM cache WHERE stored < (SELECT stored FROM "
+                    "cache ORDER BY stored DESC LIMIT 1 OFFSET ?)",
+                    (self.maxsize - 1,),
+                )
+
+        # The cache is only an optimisation; if another process holds
+        # the lock for too long, we just skip storing the item.
+        except sqlite3.Error:
+            pass
+
+    def clear(self):
+        """Remove all items."""
+        with self._connect() as connection:
+            connection.execute("DELETE FROM cache")
+
+
+class QueryCache:
+    """Two-level cache for query results.
+
+    Results are looked up in a process-local LRU cache first and, if
+    configured, in a persistent cache that is shared between processes.
+
+    Parameters
+    ----------
+    maxsize : int
+        Maximum number of items to keep in each level
+
+    filename : str or None
+        If set, uses an SQLite database in this file as the shared,
+        persistent level of the cache.
+    """
+
+    def __init__(self, maxsize, filename=None):
+        self.memory = LRUCache(maxsize)
+        self.disk = SQLiteCache(filename, maxsize) if filename else None
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Return cached item or `None` if it is missing."""
+        value = self.memory.get(key)
+
+        if value is None and self.disk is not None:
+            value = self.disk.get(key)
+
+            if value is not None:
+                self.memory.set(key, value)
+
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+
+        return value
+
+    def set(self, key, value):
+        """Store item in all levels."""
+        self.memory.set(key, value)
+
+        if self.disk is not None:
+            self.disk.set(key, value)
+
+    def clear(self):
+        """Remove all items from all levels."""
+        self.memory.clear()
+
+        if self.disk is not None:
+            self.disk.clear()
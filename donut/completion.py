@@ -0,0 +1,225 @@
+"""Prefix completion of queries.
+
+The purpose of this module is to suggest completions for partially-typed
+queries, such as `author:"vanessa r` or `tag:machine`, without running
+the match engine. Completions are served from an in-memory prefix index
+of author names, tags, and title terms, which is built from the terms
+and metadata of the database once per revision.
+"""
+
+import bisect
+import heapq
+import unidecode
+
+from donut.database import get_handle
+from donut.database import get_tags
+
+# Maximum number of completions that are returned for a query.
+MAX_COMPLETIONS = 10
+
+# Query prefixes that restrict completions to a certain type. Notice that
+# `keyword` is an alias of `tag`, mirroring the query parser.
+FIELDS = {
+    "author": "author",
+    "tag": "tag",
+    "keyword": "tag",
+    "title": "title",
+}
+
+
+def _normalise(text):
+    """Normalise text for prefix comparisons."""
+    return " ".join(unidecode.unidecode(text).lower().split())
+
+
+class PrefixIndex:
+    """Sorted-array prefix index.
+
+    The index stores normalised keys in a sorted array, such that all
+    keys sharing a prefix form a contiguous range that can be found via
+    binary search. Every item is stored under its full text and under
+    every suffix starting at a word boundary, making it possible to
+    complete "robins" to "Vanessa Robins", for instance.
+
+    Parameters
+    ----------
+    items : iterable of tuples
+        (type, text, weight) triples, where the type denotes the kind
+        of the item, such as "author", and the weight is used to rank
+        completions.
+    """
+
+    def __init__(self, items):
+        entries = []
+
+        for kind, text, weight in items:
+            words = _normalise(text).split(" ")
+
+            for index in range(len(words)):
+                key = " ".join(words[index:])
+                entries.append((key, kind, text, weight))
+
+        entries.sort()
+
+        self.keys = [entry[0] for entry in entries]
+        self.items = [entry[1:] for entry in entries]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def complete(self, prefix, kind=None, k=MAX_COMPLETIONS):
+        """Return completions of a prefix.
+
+        Parameters
+        ----------
+        prefix : str
+            Prefix to complete
+
+        kind : str or None
+            If set, only returns items of this type.
+
+        k : int
+            Maximum number of completions
+
+        Returns
+        -------
+        list of tuples
+            (type, text, weight) triples, sorted by decreasing weight.
+            Every item is reported at most once.
+        """
+        prefix = _normalise(prefix)
+
+        lo = bisect.bisect_left(self.keys, prefix)
+        hi = bisect.bisect_left(self.keys, prefix + "\uffff", lo)
+
+        candidates = {
+            self.items[index]
+            for index in range(lo, hi)
+            if kind is None or self.items[index][0] == kind
+        }
+
+        return heapq.nlargest(
+            k, candidates, key=lambda item: (item[2], item[1])
+        )
+
+
+def build_index(database_dir):
+    """Build prefix index for the current revision of a database."""
+    db = get_handle(database_dir).database
+    items = []
+
+    for item in db.allterms("XN"):
+        author = item.term.decode("utf-8")[2:]
+        items.append(("author", author, item.termfreq))
+
+    # Title terms are only available in their lowercase, unstemmed form,
+    # but this is sufficient for completing individual words.
+    for item in db.allterms("S"):
+        term = item.term.decode("utf-8")[1:]
+        items.append(("title", term, item.termfreq))
+
+    # The same tag may appear in multiple categories; we report it only
+    # once with its total count.
+    tags = {}
+    for keywords in get_tags(database_dir).values():
+        for keyword, count in keywords.items():
+            tags[keyword] = tags.get(keyword, 0) + count
+
+    items.extend(("tag", tag, count) for tag, count in tags.items())
+
+    return PrefixIndex(items)
+
+
+def get_index(database_dir):
+    """Return prefix index, building it if the database changed."""
+    handle = get_handle(database_dir)
+
+    if "completion" not in handle.cache:
+        handle.cache["completion"] = build_index(database_dir)
+
+    return handle.cache["completion"]
+
+
+def _split_query(query):
+    """Split query into its head and the partially-typed last part.
+
+    Returns
+    -------
+    Tuple (str, str or None, str)
+        The head of the query, which is retained for completions, the
+        field of the last part (`None` if no field has been specified),
+        and the partially-typed text of the last part.
+    """
+    # An unbalanced quote means that the user is still typing a phrase,
+    # which may contain whitespace.
+    if query.count('"') % 2 == 1:
+        start = query.rindex('"')
+        head, text = query[:start], query[start + 1 :]
+
+        field = None
+        for name in FIELDS:
+            if head.endswith(name + ":"):
+                field = name
+                head = head[: -len(name) - 1]
+                break
+
+        return head, field, text
+
+    tokens = query.rsplit(None, 1)
+    last = tokens[-1] if tokens and not query[-1:].isspace() else ""
+    head = query[: len(query) - len(last)]
+
+    field, sep, text = last.partition(":")
+    if sep and field in FIELDS:
+        return head, field, text
+
+    return head, None, last
+
+
+def complete(database_dir, query, k=MAX_COMPLETIONS):
+    """Complete a partially-typed query.
+
+    Parameters
+    ----------
+    database_dir : str
+        Directory of database
+
+    query : str
+        Query typed so far; only its last part will be completed.
+
+    k : int
+        Maximum number of completions
+
+    Returns
+    -------
+    list of dict
+        Completions, ordered by decreasing number of documents. Every
+        completion contains its `type`, the completed `value`, the
+        number of documents (`count`), and the full completed `query`.
+    """
+    head, field, text = _split_query(query)
+
+    if not text:
+        return []
+
+    kind = FIELDS.get(field)
+    completions = []
+
+    for item_kind, value, count in get_index(database_dir).complete(
+        text, kind, k
+    ):
+        if item_kind == "title":
+            part = value if field is None else f"{field}:{value}"
+        else:
+            part = f'{item_kind}:"{value}"'
+
+        completions.append(
+            {
+                "type": item_kind,
+                "value": value,
+                "count": count,
+                "query": head + part,
+            }
+        )
+
+    return completions
@@ -1,39 +1,259 @@
 """Database module."""
 
+import array
 import collections
+import contextlib
+import datetime
+import heapq
+import itertools
 import json
+import logging
+import os
 import random
+import threading
+import time
 import unidecode
 import xapian
 
-from donut.parse_bibtex import get_entries
+from donut.cache import LRUCache
+from donut.cache import QueryCache
 
+from donut.duplicates import SIMILARITY_THRESHOLD
+from donut.duplicates import estimate_similarity
+from donut.duplicates import get_bands
+from donut.duplicates import get_first_author
+from donut.duplicates import normalise_doi
+from donut.duplicates import serialise_signature
+from donut.duplicates import unserialise_signature
 
-def index_documents(data_filename, database_dir):
-    """Index documents from data file.
+from donut.metrics import MATCHES
+from donut.metrics import timed
+from donut.metrics import timer
 
-    This function will index documents from a database of BibTeX
-    entries. Duplicate entries will be detected based on the key
-    of the entry. Thus, this function is idempotent.
+from donut.parse_bibtex import format_bibtex
+from donut.parse_bibtex import iter_entries
+
+from donut.utils import flat_tags_to_hierarchy
+
+# Version of the stored document format. Increase this whenever the way
+# documents are stored changes; indices built with an older version have
+# to be rebuilt. Version 1 denotes the original format, which stored the
+# full (indented) entry, including its raw BibTeX fields, as data.
+FORMAT_VERSION = 10
+
+# Value slots used for storing additional information about documents.
+# Numerical values are serialised such that they can be sorted.
+SLOT_RAW = 0
+SLOT_YEAR = 1
+SLOT_TYPE = 2
+SLOT_BIBTEX = 5
+SLOT_SIGNATURE = 6
+
+# Tags and categories are stored one per slot, in consecutive slots
+# starting at these slots, such that they can be counted by the match
+# engine. Further tags or categories of a document are not counted.
+SLOT_TAGS = 100
+SLOT_CATEGORIES = 200
+MAX_TAG_SLOTS = 100
+MAX_CATEGORY_SLOTS = 100
+
+# Maximum number of tags that are reported as facets of a search.
+MAX_TAG_FACETS = 20
+
+# Minimum number of matches that are checked for calculating facets.
+# Facets of queries with more matches are estimated from the matches
+# that have been checked.
+FACET_CHECK_AT_LEAST = 1000
+
+# Number of related documents that are stored for every document, and
+# the number of expansion terms used to find them.
+RELATED_SIZE = 5
+RELATED_TERMS = 20
+
+# Prefixes of the terms considered for finding related documents, i.e.
+# title, abstract, and tag terms, both in their stemmed and unstemmed
+# forms.
+RELATED_PREFIXES = (b"S", b"XA", b"K", b"ZS", b"ZXA", b"ZK")
+
+# Number of entries after which changes are committed when indexing a
+# single large file.
+COMMIT_SIZE = 1000
+
+# Number of documents that are decoded at once when iterating over all
+# matches of a query.
+BATCH_SIZE = 100
+
+# Maximum number of filter combinations whose matching documents are
+# kept for picking random documents.
+RANDOM_CACHE_SIZE = 256
+
+# Supported orders of search results. Ordering by year shows the newest
+# documents first.
+SORT_ORDERS = ["relevance", "year"]
+
+# Default number of matches that are shown on a single page of search
+# results.
+PAGE_SIZE = 20
+
+# Process-local storage of open database handles. Handles are stored per
+# thread because `xapian.Database` objects must not be shared between
+# threads; for the usual synchronous `gunicorn` workers, this amounts to
+# one handle per worker.
+_handles = threading.local()
+
+logger = logging.getLogger(__name__)
+
+# Cache for search results; use `configure_query_cache` to change it.
+_query_cache = QueryCache(1024)
+
+
+def configure_query_cache(maxsize, filename=None):
+    """Configure cache for search results.
 
     Parameters
     ----------
-    data_filename : str
-        Filename for loading data from
+    maxsize : int
+        Maximum number of results to keep. A size of zero disables the
+        cache.
+
+    filename : str or None
+        If set, results are additionally stored in an SQLite database,
+        which makes it possible to share them between processes.
+    """
+    global _query_cache
+    _query_cache = QueryCache(maxsize, filename)
+
+
+def get_query_cache_stats():
+    """Return number of hits and misses of the search result cache."""
+    return {"hits": _query_cache.hits, "misses": _query_cache.misses}
+
+
+def type_term(entry_type):
+    """Return boolean term for filtering by entry type."""
+    return "XT" + entry_type.lower()
+
 
+def year_term(year):
+    """Return boolean term for filtering by year."""
+    return "Y" + str(year).strip()
+
+
+def category_term(category):
+    """Return boolean term for filtering by a tag category."""
+    return "XC" + category
+
+
+def tag_term(category, tag):
+    """Return boolean term for filtering by an exact tag of a category."""
+    return "XK" + category + ":" + tag.lower()
+
+
+def exact_tag_term(tag):
+    """Return boolean term for filtering by an exact tag of any category."""
+    return "XG" + tag.lower()
+
+
+def author_term(author):
+    """Return boolean term for an exact author name."""
+    return "XN" + " ".join(author.split())
+
+
+def doi_term(doi):
+    """Return boolean term for finding documents by their DOI."""
+    return "XD" + normalise_doi(doi)
+
+
+def band_term(band):
+    """Return boolean term for a band of a MinHash signature."""
+    return "XH" + band
+
+
+def _encode(obj):
+    """Encode object as compact JSON string."""
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False)
+
+
+@contextlib.contextmanager
+def writable_database(database_dir):
+    """Open database for writing within a single transaction.
+
+    All changes are committed at once when leaving the context, after
+    the derived information, such as the tag statistics, has been
+    updated. Callers may commit earlier via :func:`checkpoint`. If an
+    error occurs, all changes since the last commit are discarded.
+
+    Parameters
+    ----------
     database_dir : str
-        Directory for database
+        Directory for database; will be created if it does not exist
+
+    Yields
+    ------
+    xapian.WritableDatabase
+        Database to write to
     """
     db = xapian.WritableDatabase(database_dir, xapian.DB_CREATE_OR_OPEN)
+    db.begin_transaction()
+
+    try:
+        yield db
+
+        _commit_transaction(db)
+    except BaseException:
+        db.cancel_transaction()
+        raise
+    finally:
+        db.close()
+
+
+def _commit_transaction(db):
+    """Update derived information and commit the current transaction."""
+    update_tag_statistics(db)
+    db.set_metadata("format", str(FORMAT_VERSION))
+    db.set_metadata("updated", str(int(time.time())))
+    db.commit_transaction()
+
+
+def checkpoint(db):
+    """Commit changes of a writable database and start a new transaction.
+
+    The derived information is updated just like when leaving the
+    context of :func:`writable_database`, so the database is consistent
+    after every checkpoint.
+    """
+    _commit_transaction(db)
+    db.begin_transaction()
 
+
+def _make_termgenerator(db):
+    """Create term generator for indexing documents of a database."""
     termgenerator = xapian.TermGenerator()
     termgenerator.set_database(db)
     termgenerator.set_flags(termgenerator.FLAG_SPELLING)
     termgenerator.set_stemmer(xapian.Stem("en"))
 
-    # TODO: Make this configurable; we could potentially also support
-    # other types of collections.
-    entries = get_entries(data_filename)
+    return termgenerator
+
+
+def index_entries(db, entries):
+    """Index processed entries.
+
+    Parameters
+    ----------
+    db : xapian.WritableDatabase
+        Database to write to
+
+    entries : iterable of dict
+        Entries, as created by :func:`donut.parse_bibtex.get_entries`
+
+    Returns
+    -------
+    int
+        Number of indexed entries
+    """
+    termgenerator = _make_termgenerator(db)
+    n_entries = 0
 
     for entry in entries:
         title = entry["title"]
@@ -52,6 +272,8 @@ def index_documents(data_filename, database_dir):
             termgenerator.index_text(author, 1, "A")
             termgenerator.index_text(author)
 
+            doc.add_boolean_term(author_term(author))
+
             # Make sure that we can properly handle authors whose names
             # include accents.
             author_normalised = unidecode.unidecode(author)
@@ -68,58 +290,368 @@ def index_documents(data_filename, database_dir):
 
         termgenerator.increase_termpos()
 
-        # We deliberately ignore any categories here. The categories
-        # will only be relevant for rendering later on.
-        for _, keyword in entry["keywords"]:
+        # Categories are not part of the free-text index; they are only
+        # stored in the boolean terms, which support exact filtering.
+        for category, keyword in entry["keywords"]:
             termgenerator.index_text(keyword, 1, "K")
             termgenerator.index_text(keyword)
 
+            doc.add_boolean_term(tag_term(category, keyword))
+
         termgenerator.increase_termpos()
 
-        # FIXME: This is for debugging purposes only: we store the full
-        # entry as a nicely-formatted object.
-        doc.set_data(json.dumps(entry, indent=4))
+        doc.add_boolean_term(type_term(entry["type"]))
+        doc.add_boolean_term(year_term(entry["year"]))
+
+        categories = {category for category, _ in entry["keywords"]}
+        tags = {keyword.lower() for _, keyword in entry["keywords"]}
+
+        for category in categories:
+            doc.add_boolean_term(category_term(category))
+
+        # Exact tags, regardless of their category; these are the values
+        # reported in the tag facets, so filtering by them matches the
+        # facet counts.
+        for tag in tags:
+            doc.add_boolean_term(exact_tag_term(tag))
+
+        # Terms for detecting duplicates; documents sharing any of them
+        # are candidates for duplicates. See `find_duplicates`.
+        if normalise_doi(entry.get("doi", "")):
+            doc.add_boolean_term(doi_term(entry["doi"]))
+
+        signature = entry.get("signature")
+        if signature:
+            for band in get_bands(signature):
+                doc.add_boolean_term(band_term(band))
+
+            doc.add_value(SLOT_SIGNATURE, serialise_signature(signature))
+
+        # Values are used for sorting search results, range queries,
+        # and for calculating facets of search results.
+        try:
+            year = int(entry["year"])
+            doc.add_value(SLOT_YEAR, xapian.sortable_serialise(year))
+        except ValueError:
+            pass
+
+        doc.add_value(SLOT_TYPE, entry["type"].lower())
+
+        for index, tag in enumerate(sorted(tags)[:MAX_TAG_SLOTS]):
+            doc.add_value(SLOT_TAGS + index, tag)
+
+        for index, category in enumerate(
+            sorted(categories)[:MAX_CATEGORY_SLOTS]
+        ):
+            doc.add_value(SLOT_CATEGORIES + index, category)
+
+        # Only the fields required for rendering are stored as data of
+        # the document. The raw entry and its serialised form are only
+        # required for exporting a document, so we store them separately
+        # and never decode them when showing a list of results.
+        record = {
+            k: v
+            for k, v in entry.items()
+            if k not in ["raw", "bibtex", "signature"]
+        }
+        record["v"] = FORMAT_VERSION
+
+        doc.set_data(_encode(record))
+        doc.add_value(SLOT_RAW, _encode(entry["raw"]))
+        doc.add_value(SLOT_BIBTEX, entry["bibtex"])
 
         id_term = "Q" + identifier
         doc.add_boolean_term(id_term)
         db.replace_document(id_term, doc)
+        n_entries += 1
 
-    db.close()
+    return n_entries
 
 
-def _build_match(document):
-    """Build match from document."""
-    identifier = document.get_docid()
-    data = json.loads(document.get_data())
-    return {"id": identifier, "document": data}
+def delete_entries(db, identifiers):
+    """Delete entries from database.
 
+    Parameters
+    ----------
+    db : xapian.WritableDatabase
+        Database to write to
 
-def search(database_dir, query_str):
-    """Search data base with given query string.
+    identifiers : iterable of str
+        Keys of the entries to delete
+    """
+    for identifier in identifiers:
+        db.delete_document("Q" + identifier)
+        db.set_metadata(_related_key(identifier), "")
+
+
+def get_identifiers(db):
+    """Return keys of all entries stored in a database."""
+    return [item.term.decode("utf-8")[1:] for item in db.allterms("Q")]
+
+
+def _get_docid(db, identifier):
+    """Return document ID of an entry, or `None` if it does not exist."""
+    for item in db.postlist("Q" + identifier):
+        return item.docid
+
+    return None
+
+
+def get_entry(db, identifier):
+    """Return stored fields and raw entry of an entry.
+
+    Returns
+    -------
+    dict or None
+        Fields of the entry as stored in the database, with the raw
+        BibTeX entry under `raw`, or `None` if the entry does not exist
+    """
+    docid = _get_docid(db, identifier)
+    if docid is None:
+        return None
+
+    document = db.get_document(docid)
+
+    entry = json.loads(document.get_data())
+    entry["raw"] = _get_raw(document)
+
+    return entry
+
+
+def find_duplicates(db, identifiers, threshold=SIMILARITY_THRESHOLD):
+    """Find duplicates of entries.
+
+    Candidates are documents sharing the DOI or at least one band of the
+    MinHash signature of an entry, so only a few documents have to be
+    compared with every entry. Candidates are only reported if they have
+    the same first author as the entry and if they either have the same
+    DOI or their estimated similarity exceeds a threshold.
 
     Parameters
     ----------
+    db : xapian.Database
+        Database to search
+
+    identifiers : iterable of str
+        Keys of the entries whose duplicates should be found
+
+    threshold : float
+        Minimum estimated Jaccard similarity of titles and abstracts
+
+    Returns
+    -------
+    list of dict
+        Duplicates, sorted by their keys. Every duplicate contains the
+        sorted keys of both entries (`ids`), the `reason` for reporting
+        them (either "doi" or "similarity"), and their estimated
+        `similarity`. Every pair is reported only once.
+    """
+    duplicates = {}
+
+    for identifier in identifiers:
+        docid = _get_docid(db, identifier)
+        if docid is None:
+            continue
+
+        doc = db.get_document(docid)
+        value = doc.get_value(SLOT_SIGNATURE)
+        signature = unserialise_signature(value) if value else None
+        author = get_first_author(json.loads(doc.get_data())["author"])
+
+        candidates = {}
+        for item in doc.termlist():
+            term = item.term.decode("utf-8")
+
+            if term.startswith("XD"):
+                reason = "doi"
+            elif term.startswith("XH"):
+                reason = "similarity"
+            else:
+                continue
+
+            for posting in db.postlist(term):
+                if posting.docid != docid:
+                    candidates.setdefault(posting.docid, reason)
+
+        for candidate, reason in candidates.items():
+            other = db.get_document(candidate)
+            data = json.loads(other.get_data())
+
+            if get_first_author(data["author"]) != author:
+                continue
+
+            value = other.get_value(SLOT_SIGNATURE)
+
+            similarity = 0.0
+            if signature and value:
+                similarity = estimate_similarity(
+                    signature, unserialise_signature(value)
+                )
+
+            if reason == "doi" or similarity >= threshold:
+                key = tuple(sorted([identifier, data["id"]]))
+                duplicates.setdefault(
+                    key,
+                    {
+                        "ids": list(key),
+                        "reason": reason,
+                        "similarity": similarity,
+                    },
+                )
+
+    return [duplicates[key] for key in sorted(duplicates)]
+
+
+def index_documents(data_filename, database_dir, commit_size=COMMIT_SIZE):
+    """Index documents from data file.
+
+    This function will index documents from a database of BibTeX
+    entries. Duplicate entries will be detected based on the key
+    of the entry. Thus, this function is idempotent.
+
+    Entries are read and indexed incrementally, and changes are
+    committed after every batch of entries, so memory consumption does
+    not depend on the size of the file. In contrast to a reindex, the
+    changes thus become visible to readers batch by batch, and if an
+    error occurs, previously committed batches remain in the database.
+
+    Parameters
+    ----------
+    data_filename : str
+        Filename for loading data from; use "-" to read from standard
+        input.
+
     database_dir : str
-        Directory of database
+        Directory for database
 
-    query_str : str or None
-        String to search database for. If `None`, the method will return
-        `None` as well.
+    commit_size : int
+        Number of entries after which changes are committed
 
     Returns
     -------
-    Tuple (list of dict, query string) or None
-        Matches corresponding to the query or `None`, if no query string was
-        provided. If matches are returned, the second component of the
-        tuple contains a corrected query string (potentially empty).
+    int
+        Number of indexed entries
     """
-    # Being explicit here: whether the string is empty or `None`, we
-    # will always return *no* matches.
-    if query_str is None or query_str == "":
-        return None
+    # TODO: Make this configurable; we could potentially also support
+    # other types of collections.
+    entries = iter_entries(data_filename)
+    identifiers = []
+
+    with writable_database(database_dir) as db:
+        while True:
+            batch = list(itertools.islice(entries, commit_size))
+
+            if not batch:
+                break
+
+            index_entries(db, batch)
+            identifiers.extend(entry["id"] for entry in batch)
+
+            checkpoint(db)
+
+        # Related documents can only be calculated once all entries are
+        # available.
+        update_related(db, identifiers)
+
+    return len(identifiers)
+
+
+def update_tag_statistics(db):
+    """Calculate tag statistics and store them in the database.
+
+    The statistics are calculated from the boolean tag terms, so they
+    are always consistent with the documents in the database, even if
+    documents have been replaced. The counts and the hierarchy used for
+    rendering are stored as metadata, making it possible to read them
+    without touching any documents.
+
+    Parameters
+    ----------
+    db : xapian.WritableDatabase
+        Database to update
+    """
+    tags = collections.defaultdict(dict)
+
+    for item in db.allterms("XK"):
+        category, keyword = item.term.decode("utf-8")[2:].split(":", 1)
+        tags[category][keyword] = item.termfreq
+
+    hierarchy = flat_tags_to_hierarchy(
+        {
+            category: sorted(keywords.items())
+            for category, keywords in sorted(tags.items())
+        }
+    )
+
+    db.set_metadata("tags", _encode(tags))
+    db.set_metadata("tags:hierarchy", _encode(hierarchy))
+
+
+class _RelatedTermDecider(xapian.ExpandDecider):
+    """Only accept terms that are suitable for finding related documents."""
+
+    def __call__(self, term):
+        return term.startswith(RELATED_PREFIXES)
+
+
+def _related_key(identifier):
+    """Return metadata key of the related documents of an entry."""
+    return "related:" + identifier
+
+
+def update_related(db, identifiers, k=RELATED_SIZE):
+    """Calculate related documents and store them in the database.
 
-    db = xapian.Database(database_dir)
+    The related documents of an entry are found by using the entry as
+    the only relevant document, expanding it into its most informative
+    title, abstract, and tag terms, and searching for these terms. This
+    is too costly to be done for every displayed document, so the
+    results are stored as metadata, containing the document IDs of the
+    related documents.
 
+    Only the given entries are updated. Related documents of other
+    entries may thus refer to deleted documents, or miss documents
+    that have been added later, until they are updated as well.
+
+    Parameters
+    ----------
+    db : xapian.WritableDatabase
+        Database to update
+
+    identifiers : iterable of str
+        Keys of the entries to update
+
+    k : int
+        Number of related documents to store for every entry
+    """
+    enquire = xapian.Enquire(db)
+    decider = _RelatedTermDecider()
+
+    for identifier in identifiers:
+        docid = _get_docid(db, identifier)
+        if docid is None:
+            continue
+
+        rset = xapian.RSet()
+        rset.add_document(docid)
+
+        eset = enquire.get_eset(RELATED_TERMS, rset, decider)
+        terms = [item.term for item in eset]
+
+        related = []
+        if terms:
+            enquire.set_query(xapian.Query(xapian.Query.OP_OR, terms))
+            related = [
+                match.docid
+                for match in enquire.get_mset(0, k + 1)
+                if match.docid != docid
+            ][:k]
+
+        db.set_metadata(_related_key(identifier), _encode(related))
+
+
+def _make_queryparser(db):
+    """Create query parser for a database."""
     queryparser = xapian.QueryParser()
     queryparser.set_database(db)
     queryparser.set_stemmer(xapian.Stem("en"))
@@ -131,74 +663,839 @@ def search(database_dir, query_str):
     queryparser.add_prefix("tag", "K")
     queryparser.add_prefix("keyword", "K")
 
+    # Boolean prefixes act as filters, i.e. they restrict the matches
+    # without affecting their ranking.
+    queryparser.add_boolean_prefix("type", "XT")
+    queryparser.add_boolean_prefix("year", "Y")
+    queryparser.add_boolean_prefix("category", "XC")
+    queryparser.add_boolean_prefix("tagged", "XG")
+
+    # Support year ranges such as "year:2018..2021". Single years are
+    # still handled by the boolean prefix above.
+    queryparser.add_rangeprocessor(
+        xapian.NumberRangeProcessor(SLOT_YEAR, "year:")
+    )
+
+    return queryparser
+
+
+class DatabaseHandle:
+    """Persistent read-only handle of a database.
+
+    The handle keeps the database open across requests, together with
+    a query parser that is only set up once. Use :func:`get_handle` to
+    obtain a handle instead of creating one directly.
+    """
+
+    def __init__(self, database_dir):
+        self.database_dir = database_dir
+        self.pid = os.getpid()
+
+        # The directory may be a symbolic link to the current generation
+        # of the database, which is replaced when reindexing aside; see
+        # `donut.reindex`. The handle is bound to a single generation.
+        self.path = os.path.realpath(database_dir)
+
+        self.database = xapian.Database(self.path)
+        self.queryparser = _make_queryparser(self.database)
+        self.revision = self.database.get_revision()
+        self.uuid = self.database.get_uuid()
+
+        # Storage for information that is derived from the database and
+        # thus only valid for the current revision.
+        self.cache = {}
+
+        if get_format_version(self.database) < FORMAT_VERSION:
+            logger.warning(
+                "Database in %s uses an outdated format; please reindex",
+                database_dir,
+            )
+
+    def refresh(self):
+        """Reopen database in case a new revision has been committed.
+
+        Reopening is cheap when nothing changed, so this can be called
+        on every access.
+        """
+        self.database.reopen()
+        revision = self.database.get_revision()
+
+        if revision != self.revision:
+            self.revision = revision
+            self.cache = {}
+
+    @property
+    def version(self):
+        """Return string identifying the generation and revision."""
+        generation = os.path.basename(self.path)
+        return f"{generation}:{self.uuid}:{self.revision}"
+
+
+def _retry(handle, function):
+    """Call function, retrying once if the database has been modified.
+
+    Readers fail with `xapian.DatabaseModifiedError` if the revision
+    they are reading has been overwritten by subsequent commits. In
+    this case, the handle is reopened at the latest revision, and the
+    function is called again.
+    """
+    try:
+        return function()
+    except xapian.DatabaseModifiedError:
+        handle.refresh()
+        return function()
+
+
+@timed("open")
+def get_handle(database_dir):
+    """Return process-local database handle for a directory.
+
+    The handle is created on first use and reused afterwards. Every
+    call makes sure that the handle is pointing to the latest revision
+    of the database.
+    """
+    if not hasattr(_handles, "by_dir"):
+        _handles.by_dir = {}
+
+    handle = _handles.by_dir.get(database_dir)
+
+    # Handles must not survive a `fork()`; this might happen if the
+    # database is accessed prior to spawning workers. Handles of previous
+    # generations of a database are replaced as well.
+    if (
+        handle is None
+        or handle.pid != os.getpid()
+        or handle.path != os.path.realpath(database_dir)
+    ):
+        handle = DatabaseHandle(database_dir)
+        _handles.by_dir[database_dir] = handle
+    else:
+        handle.refresh()
+
+    return handle
+
+
+def get_format_version(db):
+    """Return format version of documents stored in a database.
+
+    Databases that do not store a format version have been created
+    prior to format versioning and are thus reported as version 1.
+    """
+    version = db.get_metadata("format")
+    return int(version) if version else 1
+
+
+def _build_match(document):
+    """Build match from document.
+
+    The match only contains the fields required for rendering. Use
+    :func:`_get_raw` to obtain the raw entry if required.
+    """
+    identifier = document.get_docid()
+    data = json.loads(document.get_data())
+
+    # Documents stored in the legacy format contain the raw entry; we
+    # remove it to ensure that callers see the same structure.
+    data.pop("raw", None)
+
+    return {"id": identifier, "document": data}
+
+
+def _get_raw(document):
+    """Return raw BibTeX entry of a document."""
+    raw = document.get_value(SLOT_RAW)
+
+    if raw:
+        return json.loads(raw)
+
+    # Fall back to the legacy format, which stores the raw entry in the
+    # data of the document.
+    return json.loads(document.get_data())["raw"]
+
+
+def _make_spies(db, first_slot, num_slots):
+    """Create spies for counting values of consecutive slots.
+
+    Only slots that are used by any document are considered, so the
+    number of spies depends on the maximum number of values of a
+    document, e.g. the maximum number of tags.
+    """
+    return [
+        xapian.ValueCountMatchSpy(slot)
+        for slot in range(first_slot, first_slot + num_slots)
+        if db.get_value_freq(slot) > 0
+    ]
+
+
+def _sum_counts(spies):
+    """Return counts of values over multiple spies."""
+    counts = collections.Counter()
+
+    for spy in spies:
+        counts.update(dict(_get_counts(spy)))
+
+    return counts
+
+
+def _get_counts(spy, numeric=False):
+    """Return counts of a `xapian.ValueCountMatchSpy`.
+
+    If `numeric` is set, values are assumed to be serialised numbers,
+    which are converted back to strings of integers.
+    """
+    if numeric:
+        return [
+            (str(int(xapian.sortable_unserialise(item.term))), item.termfreq)
+            for item in spy.values()
+        ]
+
+    return [
+        (item.term.decode("utf-8"), item.termfreq) for item in spy.values()
+    ]
+
+
+@timed("parse")
+def _parse_query(handle, query_str):
+    """Parse query string using the query parser of a handle."""
+    queryparser = handle.queryparser
+
     # Enable wildcard searches for the query as well. That way, folks
     # can improve their queries.
-    query = queryparser.parse_query(
+    return queryparser.parse_query(
         query_str,
         queryparser.FLAG_WILDCARD
         | queryparser.FLAG_SPELLING_CORRECTION
         | queryparser.FLAG_DEFAULT,
     )
 
-    corrected_query = queryparser.get_corrected_query_string()
 
+def _make_enquire(db, query, sort="relevance"):
+    """Create enquiry for a query, using the specified order."""
     enquire = xapian.Enquire(db)
     enquire.set_query(query)
 
-    # TODO: Potential bottleneck if the database grows very large. Maybe
-    # we should rather add some pagination here?
-    n_documents = db.get_doccount()
+    if sort == "year":
+        enquire.set_sort_by_value_then_relevance(SLOT_YEAR, True)
+
+    return enquire
+
+
+def _get_bibtex(document):
+    """Return serialised BibTeX entry of a document."""
+    bibtex = document.get_value(SLOT_BIBTEX)
+
+    if bibtex:
+        return bibtex.decode("utf-8")
+
+    # Older formats do not store the serialised entry.
+    return format_bibtex(_get_raw(document))
+
+
+def _add_fields(match, document, raw=False, bibtex=False):
+    """Add optional fields to a match of a document."""
+    if raw:
+        match["document"]["raw"] = _get_raw(document)
 
+    if bibtex:
+        match["document"]["bibtex"] = _get_bibtex(document)
+
+    return match
+
+
+def _decode_batch(handle, docids, raw=False, bibtex=False):
+    """Decode documents of a batch of document identifiers.
+
+    Documents that have been deleted in the meantime are skipped.
+    """
     matches = []
-    for match in enquire.get_mset(0, n_documents):
-        matches.append(_build_match(match.document))
 
-    return matches, corrected_query.decode("utf-8")
+    for docid in docids:
+        try:
+            document = handle.database.get_document(docid)
+        except xapian.DocNotFoundError:
+            continue
+
+        matches.append(
+            _add_fields(_build_match(document), document, raw, bibtex)
+        )
+
+    return matches
+
+
+def _iter_matches(handle, docids, raw=False, bibtex=False):
+    """Iterate over documents of a sequence of document identifiers.
+
+    The identifiers are determined once, whereas documents are decoded
+    lazily in batches, so memory consumption does not depend on the
+    number of matches, and the match itself is never repeated. If the
+    database is modified while iterating, the current batch is decoded
+    again from the latest revision.
+    """
+    for start in range(0, len(docids), BATCH_SIZE):
+        batch = docids[start : start + BATCH_SIZE]
+
+        with timer("decode"):
+            matches = _retry(
+                handle, lambda: _decode_batch(handle, batch, raw, bibtex)
+            )
+
+        yield from matches
+
+
+def iter_search(
+    database_dir,
+    query_str,
+    offset=0,
+    limit=None,
+    sort="relevance",
+    raw=False,
+    bibtex=False,
+):
+    """Iterate lazily over all matches of a query.
+
+    In contrast to :func:`search`, this function does not calculate
+    any facets, and matches are not cached. The match is run once, but
+    only the identifiers of matching documents are kept in memory.
+
+    Parameters
+    ----------
+    database_dir : str
+        Directory of database
+
+    query_str : str
+        String to search database for
+
+    offset : int
+        Index of the first match to return
+
+    limit : int or None
+        Maximum number of matches to return; if `None`, returns all
+        matches.
+
+    sort : str
+        Order of matches; one of `SORT_ORDERS`
+
+    raw : bool
+        If set, includes the raw BibTeX entry of each document under
+        the `raw` key.
+
+    bibtex : bool
+        If set, includes the serialised BibTeX entry of each document
+        under the `bibtex` key.
+
+    Returns
+    -------
+    iterable of dict
+        Matches of the query. The query is parsed immediately, so any
+        parsing errors are raised upon calling this function.
+    """
+    handle = get_handle(database_dir)
+    query = _parse_query(handle, query_str)
+
+    # The match is only run once, and only the identifiers of matching
+    # documents are kept; documents are decoded while iterating.
+    def _collect_docids():
+        db = handle.database
+        enquire = _make_enquire(db, query, sort)
+
+        size = db.get_doccount() if limit is None else max(limit, 0)
+        mset = enquire.get_mset(max(offset, 0), size)
+
+        return array.array("I", (match.docid for match in mset))
+
+    with timer("mset"):
+        docids = _retry(handle, _collect_docids)
+
+    return _iter_matches(handle, docids, raw, bibtex)
 
 
-def get_document(database_dir, identifier):
-    """Return specific document from database."""
-    db = xapian.Database(database_dir)
+def search(
+    database_dir, query_str, offset=0, pagesize=PAGE_SIZE, sort="relevance"
+):
+    """Search data base with given query string.
+
+    Parameters
+    ----------
+    database_dir : str
+        Directory of database
+
+    query_str : str or None
+        String to search database for. If `None`, the method will return
+        `None` as well.
+
+    offset : int
+        Index of the first match to return. Only the window starting at
+        this match will be retrieved from the database.
+
+    pagesize : int
+        Maximum number of matches to return.
+
+    sort : str
+        Order of matches; one of `SORT_ORDERS`. When sorting by year,
+        matches of the same year are ordered by relevance.
+
+    Returns
+    -------
+    Tuple (list of dict, query string, int, dict) or None
+        Matches corresponding to the query or `None`, if no query string was
+        provided. If matches are returned, the second component of the
+        tuple contains a corrected query string (potentially empty),
+        while the third component contains the number of matches over
+        the *whole* database. The fourth component contains the facets
+        of all matches, i.e. a dictionary with "year", "type",
+        "category", and "tag" as keys, and lists of (value, count)
+        pairs as values. If the query has more than
+        `FACET_CHECK_AT_LEAST` matches, the counts only cover the
+        matches that have been checked, which is indicated by the
+        "estimated" key.
+
+    Notes
+    -----
+    Results are cached until the database changes; callers must thus
+    not modify them.
+    """
+    # Being explicit here: whether the string is empty or `None`, we
+    # will always return *no* matches.
+    if query_str is None or query_str == "":
+        return None
+
+    handle = get_handle(database_dir)
+
+    # Results only change with the version of the database. Whitespace
+    # does not affect the parsed query, so it is normalised to increase
+    # the number of cache hits.
+    key = (
+        database_dir,
+        handle.version,
+        " ".join(query_str.split()),
+        offset,
+        pagesize,
+        sort,
+    )
+
+    result = _query_cache.get(key)
+    if result is not None:
+        MATCHES.observe(result[2])
+        return tuple(result)
+
+    query = _parse_query(handle, query_str)
+    corrected_query = handle.queryparser.get_corrected_query_string()
+
+    def _search():
+        db = handle.database
+        enquire = _make_enquire(db, query, sort)
+
+        # The spies see the *full* set of matches, so facets are
+        # calculated without decoding any documents.
+        spies = {
+            "year": [xapian.ValueCountMatchSpy(SLOT_YEAR)],
+            "type": [xapian.ValueCountMatchSpy(SLOT_TYPE)],
+            "category": _make_spies(
+                db, SLOT_CATEGORIES, MAX_CATEGORY_SLOTS
+            ),
+            "tag": _make_spies(db, SLOT_TAGS, MAX_TAG_SLOTS),
+        }
+
+        for spy in itertools.chain.from_iterable(spies.values()):
+            enquire.add_matchspy(spy)
+
+        # Only retrieve the requested window. Up to a bound, all matches
+        # are checked for the facets, so that they are exact for all
+        # but very general queries.
+        with timer("mset"):
+            mset = enquire.get_mset(
+                max(offset, 0), max(pagesize, 0), FACET_CHECK_AT_LEAST
+            )
+
+        with timer("decode"):
+            matches = [_build_match(match.document) for match in mset]
+
+        facets = {
+            "year": sorted(_get_counts(spies["year"][0], True), reverse=True),
+            "type": sorted(
+                _get_counts(spies["type"][0]), key=lambda x: -x[1]
+            ),
+            "category": sorted(_sum_counts(spies["category"]).items()),
+            "tag": _sum_counts(spies["tag"]).most_common(MAX_TAG_FACETS),
+            "estimated": (
+                mset.get_matches_upper_bound() > FACET_CHECK_AT_LEAST
+            ),
+        }
+
+        return matches, mset.get_matches_estimated(), facets
+
+    # The spies are created anew for every attempt, so that matches of
+    # a failed attempt are not counted twice.
+    matches, num_matches, facets = _retry(handle, _search)
+
+    result = (
+        matches,
+        corrected_query.decode("utf-8"),
+        num_matches,
+        facets,
+    )
+
+    _query_cache.set(key, result)
+    MATCHES.observe(result[2])
+
+    return result
+
+
+def get_document(database_dir, identifier, raw=False, bibtex=False):
+    """Return specific document from database.
+
+    Parameters
+    ----------
+    database_dir : str
+        Directory of database
+
+    identifier : int
+        Document identifier
+
+    raw : bool
+        If set, includes the raw BibTeX entry of the document under the
+        `raw` key.
+
+    bibtex : bool
+        If set, includes the serialised BibTeX entry of the document
+        under the `bibtex` key.
+    """
+    db = get_handle(database_dir).database
     document = db.get_document(identifier)
 
-    return _build_match(document)
+    return _add_fields(_build_match(document), document, raw, bibtex)
 
 
-def get_documents(database_dir):
-    """Return all documents."""
-    db = xapian.Database(database_dir)
+def get_related(database_dir, identifier):
+    """Return related documents of a document.
 
-    matches = []
+    Related documents are precomputed; see :func:`update_related`.
 
-    for item in db.postlist(""):
-        identifier = item.docid
-        document = db.get_document(identifier)
+    Parameters
+    ----------
+    database_dir : str
+        Directory of database
 
-        matches.append(_build_match(document))
+    identifier : int
+        Document identifier
+
+    Returns
+    -------
+    list of dict
+        Matches of the related documents, ordered by decreasing
+        relevance. Documents that have been deleted in the meantime are
+        skipped.
+    """
+    db = get_handle(database_dir).database
+    document = db.get_document(identifier)
+
+    key = _related_key(json.loads(document.get_data())["id"])
+    related = json.loads(db.get_metadata(key) or "[]")
+
+    matches = []
+    for docid in related:
+        try:
+            matches.append(_build_match(db.get_document(docid)))
+        except xapian.DocNotFoundError:
+            pass
 
     return matches
 
 
+def _iter_postlist(db, term):
+    """Iterate over identifiers of documents indexed by a term.
+
+    An empty term refers to all documents.
+    """
+    return (item.docid for item in db.postlist(term))
+
+
+def iter_documents(
+    database_dir,
+    include_types=None,
+    exclude_types=None,
+    offset=0,
+    limit=None,
+    raw=False,
+    bibtex=False,
+):
+    """Iterate lazily over all documents, optionally filtered by type.
+
+    Parameters
+    ----------
+    database_dir : str
+        Directory of database
+
+    include_types : list of str or None
+        If set, only returns documents of the given entry types.
+
+    exclude_types : list of str or None
+        If set, skips documents of the given entry types.
+
+    offset : int
+        Index of the first document to return
+
+    limit : int or None
+        Maximum number of documents to return; if `None`, returns all
+        documents.
+
+    raw : bool
+        If set, includes the raw BibTeX entry of each document under
+        the `raw` key.
+
+    bibtex : bool
+        If set, includes the serialised BibTeX entry of each document
+        under the `bibtex` key.
+
+    Returns
+    -------
+    iterable of dict
+        Matches, ordered by their document identifier.
+    """
+    handle = get_handle(database_dir)
+
+    # Filtering is performed by walking the posting lists of the boolean
+    # terms of the entry types, which are ordered by document identifier.
+    # Non-matching documents are thus never decoded.
+    def _collect_docids():
+        db = handle.database
+
+        if include_types:
+            docids = heapq.merge(
+                *(
+                    _iter_postlist(db, type_term(entry_type))
+                    for entry_type in set(include_types)
+                )
+            )
+        else:
+            docids = _iter_postlist(db, "")
+
+        excluded = {
+            docid
+            for entry_type in exclude_types or []
+            for docid in _iter_postlist(db, type_term(entry_type))
+        }
+
+        docids = (docid for docid in docids if docid not in excluded)
+        stop = None if limit is None else max(offset, 0) + max(limit, 0)
+
+        return array.array(
+            "I", itertools.islice(docids, max(offset, 0), stop)
+        )
+
+    with timer("mset"):
+        docids = _retry(handle, _collect_docids)
+
+    return _iter_matches(handle, docids, raw, bibtex)
+
+
+def get_documents(database_dir, include_types=None, exclude_types=None):
+    """Return all documents, optionally filtered by their entry type.
+
+    Parameters
+    ----------
+    database_dir : str
+        Directory of database
+
+    include_types : list of str or None
+        If set, only returns documents of the given entry types.
+
+    exclude_types : list of str or None
+        If set, skips documents of the given entry types.
+
+    Returns
+    -------
+    list of dict
+        Matches, ordered by their document identifier.
+    """
+    return list(iter_documents(database_dir, include_types, exclude_types))
+
+
+def get_revision(database_dir):
+    """Return current revision of database."""
+    return get_handle(database_dir).revision
+
+
+def get_version(database_dir):
+    """Return string that identifies the current state of a database.
+
+    In contrast to the revision, the version is also unique across
+    different databases, including databases that have been rebuilt
+    from scratch or swapped in as a new generation.
+    """
+    return get_handle(database_dir).version
+
+
+def get_last_modified(database_dir):
+    """Return time of the last modification of a database.
+
+    Returns
+    -------
+    datetime.datetime or None
+        Time of the last modification in UTC or `None` if the database
+        has been built without storing this information.
+    """
+    updated = get_handle(database_dir).database.get_metadata("updated")
+
+    if not updated:
+        return None
+
+    return datetime.datetime.fromtimestamp(
+        int(updated), datetime.timezone.utc
+    )
+
+
 def get_num_documents(database_dir):
     """Return number of documents in database."""
-    db = xapian.Database(database_dir, xapian.DB_OPEN)
+    db = get_handle(database_dir).database
     num_documents = db.get_doccount()
 
     return num_documents
 
 
-def get_random_document(database_dir):
-    """Return random document from database."""
-    db = xapian.Database(database_dir)
-    identifier = random.randint(1, db.get_lastdocid())
-    document = db.get_document(identifier)
+def _get_docids(handle, term):
+    """Return identifiers of all documents indexed by a term.
+
+    The identifiers are cached for the current revision of the database,
+    so this must only be called for terms that are known to exist. An
+    empty term refers to all documents.
+    """
+    key = ("docids", term)
+
+    if key not in handle.cache:
+        handle.cache[key] = array.array(
+            "I", _iter_postlist(handle.database, term)
+        )
+
+    return handle.cache[key]
+
+
+def _get_entry_types(handle):
+    """Return all entry types of the documents of a database."""
+    if "types" not in handle.cache:
+        handle.cache["types"] = {
+            item.term.decode("utf-8")[len(type_term("")) :]
+            for item in handle.database.allterms(type_term(""))
+        }
+
+    return handle.cache["types"]
+
+
+def _get_tag_names(handle):
+    """Return all tags of a database, regardless of their category."""
+    if "tags:names" not in handle.cache:
+        handle.cache["tags:names"] = {
+            tag.lower()
+            for tags in _load_tags(handle).values()
+            for tag in tags
+        }
+
+    return handle.cache["tags:names"]
+
+
+def _get_filtered_docids(handle, include_types, exclude_types, tag):
+    """Return identifiers of all documents that satisfy some filters.
+
+    Only entry types and tags that occur in the database are looked up,
+    so the number of cached identifiers is bounded by the number of
+    types and tags. Filters with unknown values do not match anything,
+    and unknown entry types to exclude are ignored.
+    """
+    types = _get_entry_types(handle)
+
+    if any(entry_type not in types for entry_type in include_types):
+        return array.array("I")
+
+    if tag and tag not in _get_tag_names(handle):
+        return array.array("I")
+
+    exclude_types = tuple(t for t in exclude_types if t in types)
+
+    if not include_types and not exclude_types and not tag:
+        return _get_docids(handle, "")
+
+    if "random" not in handle.cache:
+        handle.cache["random"] = LRUCache(RANDOM_CACHE_SIZE)
+
+    key = (include_types, exclude_types, tag)
+    docids = handle.cache["random"].get(key)
+
+    if docids is not None:
+        return docids
+
+    docids = set(_get_docids(handle, ""))
+
+    if include_types:
+        docids &= {
+            docid
+            for entry_type in include_types
+            for docid in _get_docids(handle, type_term(entry_type))
+        }
+
+    for entry_type in exclude_types:
+        docids -= set(_get_docids(handle, type_term(entry_type)))
+
+    if tag:
+        docids &= set(_get_docids(handle, exact_tag_term(tag)))
+
+    docids = array.array("I", sorted(docids))
+    handle.cache["random"].set(key, docids)
 
+    return docids
+
+
+def get_random_document(
+    database_dir, include_types=None, exclude_types=None, tag=None
+):
+    """Return random document from database.
+
+    Documents are picked uniformly at random from the identifiers of
+    all existing documents, so gaps caused by deleted documents do not
+    matter. The identifiers are only collected once per revision of the
+    database.
+
+    Parameters
+    ----------
+    database_dir : str
+        Directory of database
+
+    include_types : list of str or None
+        If set, only picks documents of the given entry types.
+
+    exclude_types : list of str or None
+        If set, never picks documents of the given entry types.
+
+    tag : str or None
+        If set, only picks documents with this tag.
+
+    Returns
+    -------
+    dict or None
+        Match of the random document or `None` if no document satisfies
+        the filters.
+    """
+    handle = get_handle(database_dir)
+
+    docids = _get_filtered_docids(
+        handle,
+        tuple(t.lower() for t in include_types or []),
+        tuple(t.lower() for t in exclude_types or []),
+        tag.lower() if tag else None,
+    )
+
+    if not docids:
+        return None
+
+    document = handle.database.get_document(random.choice(docids))
     return _build_match(document)
 
 
 def get_tags(database_dir):
     """Return all tags of all documents.
 
+    The tags are read from the statistics that are calculated when
+    indexing documents; no documents will be decoded.
+
     Returns
     -------
     dict of counters
@@ -206,15 +1503,35 @@ def get_tags(database_dir):
         such as "applications", whereas each value of the dictionary
         will be a counter with the respective tags.
     """
-    db = xapian.Database(database_dir)
-    tags = collections.defaultdict(collections.Counter)
+    return _load_tags(get_handle(database_dir))
+
 
-    for item in db.postlist(""):
-        identifier = item.docid
-        document = db.get_document(identifier)
-        data = json.loads(document.get_data())
+def _load_tags(handle):
+    """Return tag statistics of the database of a handle."""
+    if "tags" not in handle.cache:
+        tags = json.loads(handle.database.get_metadata("tags") or "{}")
+        handle.cache["tags"] = {
+            category: collections.Counter(keywords)
+            for category, keywords in tags.items()
+        }
+
+    return handle.cache["tags"]
+
+
+def get_tag_hierarchy(database_dir):
+    """Return hierarchy of all tags, sorted by category and tag.
+
+    Returns
+    -------
+    dict
+        Dictionary with categories as keys and lists of (tag, count)
+        pairs as values. The lists contain additional level markers,
+        following :func:`donut.utils.flat_tags_to_hierarchy`.
+    """
+    handle = get_handle(database_dir)
 
-        for category, keyword in data["keywords"]:
-            tags[category][keyword.lower()] += 1
+    if "tags:hierarchy" not in handle.cache:
+        hierarchy = handle.database.get_metadata("tags:hierarchy")
+        handle.cache["tags:hierarchy"] = json.loads(hierarchy or "{}")
 
-    return tags
+    return handle.cache["tags:hierarchy"]
@@ -3,19 +3,34 @@
 Normally, you should not have to run this script. It was developed to
 manually test the insertion of articles in the database, and to debug
 their parsing process.
+
+Entries are read incrementally, so arbitrarily large exports can be
+indexed. Use "-" as the filename to read entries from standard input.
 """
 
 from dotenv import load_dotenv
 
 from donut.database import index_documents
 
+import argparse
 import os
 
 load_dotenv()
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "filename",
+        nargs="?",
+        default="/tmp/tda.bib",
+        help="BibTeX file to index, or '-' for standard input",
+    )
+
+    args = parser.parse_args()
+
     DATABASE_DIR = os.getenv("DATABASE_DIR", "database")
     assert DATABASE_DIR is not None
 
-    index_documents("/tmp/tda.bib", DATABASE_DIR)
+    n_entries = index_documents(args.filename, DATABASE_DIR)
+    print(f"Indexed {n_entries} entries")
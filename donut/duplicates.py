@@ -0,0 +1,188 @@
+"""Detection of duplicate publications.
+
+The same publication may be contained in multiple files, for instance
+when an entry has been exported twice under different keys. Such
+duplicates are detected in two ways:
+
+1. Entries with the same DOI are considered to be duplicates.
+2. Entries whose normalised titles and abstracts are sufficiently
+   similar are considered to be duplicates.
+
+In both cases, the entries also have to share their first author, since
+neither DOIs nor similar abstracts are sufficient on their own: DOIs are
+occasionally copied to the wrong entry, and follow-up publications tend
+to reuse large parts of their abstracts.
+
+Comparing all pairs of entries is quadratic, so similarity is estimated
+via MinHash signatures of word shingles instead. Signatures are split
+into bands, and only entries that agree on all rows of at least one
+band, i.e. that share a locality-sensitive hash, become candidates for
+a comparison. The bands are stored as boolean terms of the database, so
+candidates can be found via a single posting list lookup per band.
+"""
+
+import array
+import hashlib
+import random
+import re
+import unidecode
+
+# Number of hash functions of a MinHash signature.
+NUM_PERMUTATIONS = 64
+
+# Number of bands the signature is split into. With 16 bands of 4 rows,
+# pairs of entries become candidates with a probability of 50% if their
+# Jaccard similarity is about 0.5, and with more than 99% if it is at
+# least 0.8.
+NUM_BANDS = 16
+
+# Number of consecutive words that form a shingle.
+SHINGLE_SIZE = 3
+
+# Minimum estimated Jaccard similarity of duplicates.
+SIMILARITY_THRESHOLD = 0.8
+
+# Entry types and journals of preprints, which are superseded by the
+# published version of an entry when merging duplicates.
+PREPRINT_TYPES = {"misc", "online", "report", "unpublished"}
+PREPRINT_SERVERS = ["arxiv", "biorxiv", "medrxiv", "ssrn", "preprint"]
+
+# Universal hash functions of the form (a * x + b) mod p. The functions
+# are seeded such that signatures are comparable across runs.
+_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+
+_rng = random.Random(42)
+_PERMUTATIONS = [
+    (_rng.randrange(1, _PRIME), _rng.randrange(0, _PRIME))
+    for _ in range(NUM_PERMUTATIONS)
+]
+
+
+def normalise_doi(doi):
+    """Normalise DOI for comparisons.
+
+    DOIs are case-insensitive; we also remove common URL and scheme
+    prefixes, which are not part of the DOI itself.
+    """
+    doi = doi.strip().lower()
+    doi = re.sub(r"^(https?://)?(dx\.)?doi\.org/", "", doi)
+    doi = re.sub(r"^doi:\s*", "", doi)
+
+    return doi
+
+
+def get_first_author(authors):
+    """Return normalised last name of the first author of an entry.
+
+    Authors are formatted as "first middle last" names, so the last
+    word is used. First names are ignored, since they are frequently
+    abbreviated in only one of the entries. If there are no authors, an
+    empty string is returned.
+    """
+    if not authors:
+        return ""
+
+    words = unidecode.unidecode(authors[0]).lower().split()
+    return words[-1] if words else ""
+
+
+def is_preprint(entry_type, raw):
+    """Check whether an entry refers to a preprint.
+
+    Preprints are either stored with an unpublished entry type, or as
+    articles whose journal is a preprint server such as arXiv.
+    """
+    if entry_type.lower() in PREPRINT_TYPES:
+        return True
+
+    journal = raw.get("journaltitle", raw.get("journal", "")).lower()
+    return any(server in journal for server in PREPRINT_SERVERS)
+
+
+def normalise_text(text):
+    """Normalise text and split it into words.
+
+    Accents, case, punctuation, and LaTeX markup, such as braces, are
+    removed, since they often differ between exports of an entry.
+    """
+    text = unidecode.unidecode(text).lower()
+    return re.findall(r"[a-z0-9]+", text)
+
+
+def get_shingles(text, k=SHINGLE_SIZE):
+    """Return set of shingles of `k` consecutive words of a text."""
+    words = normalise_text(text)
+
+    if len(words) <= k:
+        return {" ".join(words)} if words else set()
+
+    return {" ".join(words[i : i + k]) for i in range(len(words) - k + 1)}
+
+
+def _hash(shingle):
+    """Return stable 32-bit hash of a shingle."""
+    digest = hashlib.blake2b(shingle.encode("utf-8"), digest_size=4)
+    return int.from_bytes(digest.digest(), "little")
+
+
+def get_signature(shingles):
+    """Return MinHash signature of a set of shingles.
+
+    Returns
+    -------
+    array.array or None
+        Signature as an array of unsigned integers, or `None` if there
+        are no shingles.
+    """
+    if not shingles:
+        return None
+
+    hashes = [_hash(shingle) for shingle in shingles]
+
+    return array.array(
+        "I",
+        [
+            min((a * h + b) % _PRIME for h in hashes) & _MAX_HASH
+            for a, b in _PERMUTATIONS
+        ],
+    )
+
+
+def get_bands(signature):
+    """Return locality-sensitive hashes of the bands of a signature.
+
+    Every hash contains the index of its band, so identical rows in
+    different bands do not result in a collision.
+    """
+    signature = array.array("I", signature)
+
+    rows = NUM_PERMUTATIONS // NUM_BANDS
+    bands = []
+
+    for index in range(NUM_BANDS):
+        band = signature[index * rows : (index + 1) * rows]
+        digest = hashlib.blake2b(band.tobytes(), digest_size=8).hexdigest()
+        bands.append(f"{index:02d}{digest}")
+
+    return bands
+
+
+def serialise_signature(signature):
+    """Serialise signature for storing it as a value."""
+    signature = array.array("I", signature)
+    return signature.tobytes()
+
+
+def unserialise_signature(value):
+    """Restore signature from a value."""
+    signature = array.array("I")
+    signature.frombytes(value)
+
+    return signature
+
+
+def estimate_similarity(signature1, signature2):
+    """Estimate Jaccard similarity from two signatures."""
+    agreements = sum(x == y for x, y in zip(signature1, signature2))
+    return agreements / NUM_PERMUTATIONS
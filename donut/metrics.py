@@ -0,0 +1,244 @@
+"""Lightweight instrumentation of requests.
+
+This module provides two kinds of instrumentation:
+
+1. Timers for the phases of a request, such as opening the database or
+   rendering templates. Timings are collected per request and reported
+   in the `Server-Timing` header of the response.
+2. Histograms of request latencies and of the number of matches per
+   query, which are exposed in the text format of Prometheus.
+
+Like the other caches and statistics of the application, histograms
+are process-local, so every worker reports its own values. Samples are
+labelled with the `worker` that reports them, such that the values of
+different workers form separate series.
+"""
+
+import bisect
+import contextlib
+import contextvars
+import functools
+import threading
+import time
+
+# Buckets of latency histograms in seconds.
+LATENCY_BUCKETS = [
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+]
+
+# Buckets of the histogram of matches per query.
+MATCH_BUCKETS = [0, 1, 5, 10, 25, 50, 100, 250, 500, 1000]
+
+# Timings of the phases of the current request and the phases that are
+# currently being measured; `None` outside of a request, in which case
+# timers do nothing.
+_timings = contextvars.ContextVar("timings", default=None)
+_active = contextvars.ContextVar("active", default=None)
+
+
+def start_request():
+    """Start collecting timings for the current request.
+
+    Returns
+    -------
+    dict
+        Timings of the request, which are updated until the request has
+        been completed, including phases of streamed responses.
+    """
+    timings = {}
+
+    _timings.set(timings)
+    _active.set(set())
+
+    return timings
+
+
+def get_timings():
+    """Return timings of the current request in seconds.
+
+    Returns
+    -------
+    dict
+        Durations of all phases, in the order in which they started
+    """
+    timings = _timings.get()
+    return dict(timings) if timings is not None else {}
+
+
+@contextlib.contextmanager
+def timer(name):
+    """Measure the duration of a phase of the current request.
+
+    Durations of multiple occurrences of the same phase are added up.
+    Nested occurrences of a phase, such as templates being rendered
+    while rendering another template, are only counted once.
+    """
+    timings = _timings.get()
+    active = _active.get()
+
+    if timings is None or name in active:
+        yield
+        return
+
+    active.add(name)
+    timings.setdefault(name, 0.0)
+    start = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        timings[name] += time.perf_counter() - start
+        active.discard(name)
+
+
+def timed(name):
+    """Decorate function such that its calls are timed as a phase."""
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with timer(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def format_server_timing(timings):
+    """Format timings as a value of the `Server-Timing` header."""
+    return ", ".join(
+        f"{name};dur={1000 * duration:.2f}"
+        for name, duration in timings.items()
+    )
+
+
+def _format_labels(labels):
+    """Format labels of a sample in the Prometheus text format."""
+    if not labels:
+        return ""
+
+    def _escape(value):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"')
+        return value.replace("\n", "\\n")
+
+    labels = ",".join(f'{key}="{_escape(value)}"' for key, value in labels)
+    return "{" + labels + "}"
+
+
+class Histogram:
+    """Histogram of observations, optionally partitioned by labels.
+
+    Parameters
+    ----------
+    name : str
+        Name of the metric
+
+    description : str
+        Description of the metric
+
+    buckets : list of float
+        Upper bounds of the buckets, in increasing order
+
+    labels : list of str
+        Names of the labels of observations
+    """
+
+    def __init__(self, name, description, buckets, labels=()):
+        self.name = name
+        self.description = description
+        self.buckets = list(buckets)
+        self.labels = tuple(labels)
+
+        # Bucket counts, sum, and number of observations per label set.
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        """Add observation for the given values of the labels."""
+        index = bisect.bisect_left(self.buckets, value)
+
+        with self._lock:
+            if label_values not in self._values:
+                counts = [0] * (len(self.buckets) + 1)
+                self._values[label_values] = [counts, 0.0, 0]
+
+            values = self._values[label_values]
+            values[0][index] += 1
+            values[1] += value
+            values[2] += 1
+
+    def collect(self, labels=()):
+        """Return lines of the histogram in the Prometheus text format.
+
+        Parameters
+        ----------
+        labels : list of tuples
+            Additional (name, value) pairs of labels of all samples
+        """
+        constant = list(labels)
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} histogram",
+        ]
+
+        with self._lock:
+            values = sorted(
+                (key, [list(counts), total, count])
+                for key, (counts, total, count) in self._values.items()
+            )
+
+        for label_values, (counts, total, count) in values:
+            labels = constant + list(zip(self.labels, label_values))
+            cumulative = 0
+
+            for bound, n in zip(self.buckets + ["+Inf"], counts):
+                cumulative += n
+                bucket_labels = _format_labels(labels + [("le", bound)])
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {count}")
+
+        return lines
+
+
+def format_metric(name, description, kind, value, labels=()):
+    """Return lines of a single sample in the Prometheus text format."""
+    return [
+        f"# HELP {name} {description}",
+        f"# TYPE {name} {kind}",
+        f"{name}{_format_labels(labels)} {value}",
+    ]
+
+
+REQUEST_LATENCY = Histogram(
+    "donut_request_duration_seconds",
+    "Latency of requests",
+    LATENCY_BUCKETS,
+    ["route", "method"],
+)
+
+PHASE_LATENCY = Histogram(
+    "donut_phase_duration_seconds",
+    "Latency of phases of requests",
+    LATENCY_BUCKETS,
+    ["phase"],
+)
+
+MATCHES = Histogram(
+    "donut_matches_per_query",
+    "Estimated number of matches per search query",
+    MATCH_BUCKETS,
+)
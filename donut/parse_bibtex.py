@@ -1,17 +1,39 @@
 """Parse BibTeX file into records."""
 
 import bibtexparser
+import collections
+import hashlib
+import json
+import os
+import re
+import sys
+import tempfile
 
 import dateutil.parser
 
+from bibtexparser.bibdatabase import BibDatabase
 from bibtexparser.bparser import BibTexParser
+from bibtexparser.bwriter import BibTexWriter
 from bibtexparser.customization import author
 from bibtexparser.customization import convert_to_unicode
 
+from donut.duplicates import get_shingles
+from donut.duplicates import get_signature
+
 from nameparser import HumanName
 
 from titlecase import titlecase
 
+# Version of the entry processing. Increase this whenever the processed
+# entries change so that cached entries are invalidated.
+PARSER_VERSION = 3
+
+# Number of entries that are parsed at once when streaming entries.
+STREAM_BATCH_SIZE = 100
+
+# Characters that delimit entries of a BibTeX file.
+_DELIMITERS = re.compile(r'[@{}()"]')
+
 
 def customisations(record):
     """Customise record parsing.
@@ -87,12 +109,8 @@ def format_authors(authors):
     return output
 
 
-def format_metadata(keywords, identifier):
-    """Extract optional metadata from keywords.
-
-    Metadata are keywords that start with an alphabetic character. This
-    function provides a generic entry point for extracting all types of
-    metadata. The client has to set up the call correctly.
+def split_keywords(keywords):
+    """Split keyword string into its individual keywords.
 
     Parameters
     ----------
@@ -100,108 +118,99 @@ def format_metadata(keywords, identifier):
         Keyword string, as formatted by the backend. Keywords are
         separated by commas.
 
-    identifier : str
-        Indicates the identifier to extract, such as "V" for videos. All
-        other metadata will be ignored.
-
     Returns
     -------
     List of tuples
-        List of (url, title) pairs. The title is optional and will be
-        empty if the entry does not define it.
+        List of (category, keyword) pairs. For "bare" keywords without
+        a category, the category is `None`.
     """
-    metadata = []
+    output = []
     for keyword in keywords.split(","):
         # We only split at the *first* occurrence of the keyword because
         # some keywords contain additional hyphens.
         tokens = keyword.split("-", 1)
 
-        # This skips "bare" keywords; we handle those by assigning the
-        # type of application instead.
         if len(tokens) == 2:
-            category = tokens[0].strip()
-            keyword = tokens[1].strip()
+            output.append((tokens[0].strip(), tokens[1].strip()))
+        else:
+            output.append((None, tokens[0].strip()))
 
-            if category != identifier:
-                continue
+    return output
+
+
+def _format_metadata(keywords):
+    """Extract all metadata from split keywords.
+
+    Returns
+    -------
+    dict of lists
+        Dictionary with metadata identifiers, such as "V" for videos, as
+        keys and lists of (url, title) pairs as values.
+    """
+    metadata = collections.defaultdict(list)
+    for category, keyword in keywords:
+        # This skips "bare" keywords; we handle those by assigning the
+        # type of application instead.
+        if category is None:
+            continue
 
-            tokens = keyword.split()
+        tokens = keyword.split()
 
-            if len(tokens) == 0:
-                continue
+        if len(tokens) == 0:
+            continue
 
-            url = tokens[0]
-            title = ""
+        url = tokens[0]
+        title = ""
 
-            if len(tokens) >= 2:
-                title = tokens[1]
+        if len(tokens) >= 2:
+            title = tokens[1]
 
-            metadata.append((url, title))
+        metadata[category].append((url, title))
 
     return metadata
 
 
-def format_keywords(keywords):
-    """Format keywords by stripping away leading decimals.
+def format_metadata(keywords, identifier):
+    """Extract optional metadata from keywords.
 
-    A keyword has to start with a number, indicating the category,
-    followed by a string.
+    Metadata are keywords that start with an alphabetic character. This
+    function provides a generic entry point for extracting all types of
+    metadata. The client has to set up the call correctly.
+
+    Parameters
+    ----------
+    keywords : str
+        Keyword string, as formatted by the backend. Keywords are
+        separated by commas.
+
+    identifier : str
+        Indicates the identifier to extract, such as "V" for videos. All
+        other metadata will be ignored.
 
     Returns
     -------
-    Set of tuples
-        Set of (category, keyword) pairs, with categories being spelled
-        out according to the labelling scheme.
+    List of tuples
+        List of (url, title) pairs. The title is optional and will be
+        empty if the entry does not define it.
     """
-    formatted_keywords = set()
-    for keyword in keywords.split(","):
-        # We only split at the *first* occurrence of the keyword because
-        # some keywords contain additional hyphens.
-        tokens = keyword.split("-", 1)
+    return _format_metadata(split_keywords(keywords))[identifier]
 
-        # This skips "bare" keywords; we handle those by assigning the
-        # type of application instead.
-        if len(tokens) == 2:
-            category = tokens[0].strip()
-            keyword = tokens[1].strip()
-
-            category_map = {
-                "1": "applications",
-                "2": "tools",
-                "3": "data",
-            }
-
-            # If we get an alphabetic character, this is metadata and
-            # needs to be handled elsewhere.
-            if category.isalpha():
-                continue
-
-            # Parent--child keyword; split it. We thus make the article
-            # searchable using *both* tags. If an article is tagged
-            # "images:3d", for example, we want it to appear when you
-            # search for "images" and when you search for "images:3d".
-            if ":" in keyword:
-                parts = keyword.split(":")
-
-                # Add subcategory for *nested* categories, including
-                # those that have more than one parent. For example,
-                # this splits "foo:bar:baz" into "foo:bar" and "foo"
-                # respectively.
-                for index in range(len(parts) - 1):
-                    subcategory = ":".join(parts[: -(index + 1)])
-                    formatted_keywords.add(
-                        (category_map[category], subcategory)
-                    )
-
-            # Add the original keyword again, i.e. "foo:bar:baz" without
-            # additional formatting. This ensures an intact hierarchy.
-            formatted_keywords.add((category_map[category], keyword))
 
+def _format_keywords(keywords):
+    """Format split keywords; see :func:`format_keywords`."""
+    category_map = {
+        "1": "applications",
+        "2": "tools",
+        "3": "data",
+    }
+
+    formatted_keywords = set()
+    for category, keyword in keywords:
         # Bare keyword, which indicates the "flavour" of a method, i.e.
         # whether the method contributes something new or confirms some
         # existing theory.
-        elif len(tokens) == 1:
-            flavour = tokens[0].strip()
+        if category is None:
+            flavour = keyword
 
             # Not every "bare" flavour should be shown.
             valid_flavours = ["confirm", "innovate"]
@@ -210,12 +219,53 @@ def format_keywords(keywords):
             if flavour and flavour.lower() in valid_flavours:
                 formatted_keywords.add(("flavour", flavour))
 
+            continue
+
+        # If we get an alphabetic character, this is metadata and
+        # needs to be handled elsewhere.
+        if category.isalpha():
+            continue
+
+        # Parent--child keyword; split it. We thus make the article
+        # searchable using *both* tags. If an article is tagged
+        # "images:3d", for example, we want it to appear when you
+        # search for "images" and when you search for "images:3d".
+        if ":" in keyword:
+            parts = keyword.split(":")
+
+            # Add subcategory for *nested* categories, including
+            # those that have more than one parent. For example,
+            # this splits "foo:bar:baz" into "foo:bar" and "foo"
+            # respectively.
+            for index in range(len(parts) - 1):
+                subcategory = ":".join(parts[: -(index + 1)])
+                formatted_keywords.add((category_map[category], subcategory))
+
+        # Add the original keyword again, i.e. "foo:bar:baz" without
+        # additional formatting. This ensures an intact hierarchy.
+        formatted_keywords.add((category_map[category], keyword))
+
     # The `set` ensures that we only add keywords at most once even if
     # they occur multiple times (this can happen in case hierarchical
     # tags are being used).
     return sorted(set(formatted_keywords))
 
 
+def format_keywords(keywords):
+    """Format keywords by stripping away leading decimals.
+
+    A keyword has to start with a number, indicating the category,
+    followed by a string.
+
+    Returns
+    -------
+    Set of tuples
+        Set of (category, keyword) pairs, with categories being spelled
+        out according to the labelling scheme.
+    """
+    return _format_keywords(split_keywords(keywords))
+
+
 def format_doi(doi):
     """Format DOI and strip away URL parts."""
     doi = doi.replace("https://dx.doi.org/", "")
@@ -223,17 +273,30 @@ def format_doi(doi):
     return doi
 
 
+def format_bibtex(entry):
+    """Format raw entry as BibTeX string."""
+    db = BibDatabase()
+    db.entries = [entry]
+
+    return BibTexWriter().write(db)
+
+
 def process_entry(entry):
     """Process a single bibliographic entry."""
+    # Keywords also contain metadata, so we split them only once and
+    # extract everything afterwards.
+    keywords = split_keywords(entry.get("keywords", ""))
+    metadata = _format_metadata(keywords)
+
     # Will store the resulting entry as a nice dictionary, containing
     # relevant information about the paper.
     output = {
         "title": format_title(entry),
         "author": format_authors(entry["author"]),
-        "keywords": format_keywords(entry.get("keywords", "")),
-        "code": format_metadata(entry.get("keywords", ""), "C"),
-        "data": format_metadata(entry.get("keywords", ""), "D"),
-        "videos": format_metadata(entry.get("keywords", ""), "V"),
+        "keywords": _format_keywords(keywords),
+        "code": metadata["C"],
+        "data": metadata["D"],
+        "videos": metadata["V"],
         "abstract": entry.get("abstract", ""),
         "year": format_year(entry),
         "doi": format_doi(entry.get("doi", "")),
@@ -245,31 +308,205 @@ def process_entry(entry):
     return output
 
 
-def get_entries(filename):
-    """Get entries from file."""
-    parser = BibTexParser(
-        common_strings=True,
-        customization=customisations,
-        ignore_nonstandard_types=False,
-    )
+def _parse_entries(content):
+    """Parse entries from BibTeX string.
 
-    with open(filename) as f:
-        db = bibtexparser.load(f, parser=parser)
+    The string is parsed only once without any customisations, which
+    provides the "raw" entries. The customisations are subsequently
+    applied to a copy of each raw entry before processing it.
+    """
+    parser = BibTexParser(common_strings=True, ignore_nonstandard_types=False)
+    db = bibtexparser.loads(content, parser=parser)
 
-    def _get_valid_entries(db):
-        return [e for e in db.entries if "year" in e or "date" in e]
+    entries = []
+    for raw in db.entries:
+        if "year" not in raw and "date" not in raw:
+            continue
 
-    entries = _get_valid_entries(db)
-    entries = [process_entry(e) for e in entries]
+        entry = process_entry(customisations(dict(raw)))
+        entry["raw"] = raw
+        entry["bibtex"] = format_bibtex(raw)
 
-    # Read file again without any customisations, thus making it
-    # possible for us to include the "raw" entry.
-    parser = BibTexParser(common_strings=True, ignore_nonstandard_types=False)
+        # Signatures for detecting duplicates are comparatively costly,
+        # so they are calculated here, where parsing can be distributed
+        # over multiple processes and its results are cached.
+        signature = get_signature(
+            get_shingles(entry["title"] + " " + entry["abstract"])
+        )
+        entry["signature"] = list(signature) if signature else None
+
+        entries.append(entry)
 
-    with open(filename) as f:
-        db = bibtexparser.load(f, parser=parser)
+    return entries
+
+
+def get_entries(filename, cache_dir=None):
+    """Get entries from file.
+
+    Parameters
+    ----------
+    filename : str
+        BibTeX file to parse
+
+    cache_dir : str or None
+        If set, processed entries will be cached in this directory,
+        using the content of the file and the parser version as a key.
+        Unchanged files will thus not be parsed again.
+
+    Returns
+    -------
+    list of dict
+        Processed entries, each containing the raw entry under the
+        `raw` key, its serialised form under the `bibtex` key, and its
+        MinHash signature under the `signature` key.
+    """
+    with open(filename, "rb") as f:
+        content = f.read()
+
+    if cache_dir is None:
+        return _parse_entries(content.decode("utf-8"))
+
+    key = hashlib.sha256(str(PARSER_VERSION).encode() + content)
+    cache_filename = os.path.join(cache_dir, key.hexdigest() + ".json")
+
+    try:
+        with open(cache_filename) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        pass
 
-    raw_entries = _get_valid_entries(db)
-    entries = [dict(e, **{"raw": r}) for e, r in zip(entries, raw_entries)]
+    entries = _parse_entries(content.decode("utf-8"))
 
+    # Write to a temporary file first so that concurrent readers never
+    # see partial entries.
+    os.makedirs(cache_dir, exist_ok=True)
+    with tempfile.NamedTemporaryFile(
+        "w", dir=cache_dir, suffix=".tmp", delete=False
+    ) as f:
+        json.dump(entries, f)
+
+    os.replace(f.name, cache_filename)
     return entries
+
+
+def split_entries(lines):
+    """Split BibTeX source into the source of its individual entries.
+
+    Entries are delimited by counting braces, just like BibTeX does, so
+    only the current entry has to be kept in memory. In entries that are
+    delimited by parentheses, quoted values are skipped as well, so that
+    they may contain closing parentheses. Text outside of entries is
+    ignored.
+
+    Parameters
+    ----------
+    lines : iterable of str
+        Lines of BibTeX source, such as an open file
+
+    Returns
+    -------
+    iterable of str
+        Source of every entry, starting with its `@`
+    """
+    buffer = None
+    opening = None
+    depth = 0
+    quoted = False
+
+    for line in lines:
+        start = 0
+
+        for match in _DELIMITERS.finditer(line):
+            char = match.group()
+
+            # An `@` that is not followed by the body of an entry does
+            # not start an entry, so we start over with the next one.
+            if opening is None:
+                if char == "@":
+                    buffer, start = [], match.start()
+                elif buffer is not None and char in "{(":
+                    opening, depth, quoted = char, 0, False
+
+                if opening != "{":
+                    continue
+
+            # Braces are counted within quoted values as well, whereas
+            # quotes only delimit values outside of braces.
+            if char == "{":
+                depth += 1
+            elif char == "}":
+                depth -= 1
+            elif char == '"' and depth == 0:
+                quoted = not quoted
+
+            if (opening == "{" and depth == 0) or (
+                opening == "(" and char == ")" and depth == 0 and not quoted
+            ):
+                buffer.append(line[start : match.end()])
+                yield "".join(buffer)
+
+                buffer, opening = None, None
+
+        if buffer is not None:
+            buffer.append(line[start:])
+
+    # Unterminated entries are passed on, so that the parser can deal
+    # with them.
+    if buffer:
+        yield "".join(buffer)
+
+
+def _get_entry_type(source):
+    """Return type of an entry from its source."""
+    return re.split(r"[{(]", source[1:], maxsplit=1)[0].strip().lower()
+
+
+def _iter_entries(lines, batch_size=STREAM_BATCH_SIZE):
+    """Iterate over processed entries of BibTeX source."""
+    # String definitions apply to all subsequent entries; they are few
+    # and short, so we keep them around.
+    strings = []
+    batch = []
+
+    for source in split_entries(lines):
+        entry_type = _get_entry_type(source)
+
+        if entry_type == "string":
+            strings.append(source)
+        elif entry_type not in ["comment", "preamble"]:
+            batch.append(source)
+
+        if len(batch) >= batch_size:
+            yield from _parse_entries("\n".join(strings + batch))
+            batch = []
+
+    if batch:
+        yield from _parse_entries("\n".join(strings + batch))
+
+
+def iter_entries(filename, batch_size=STREAM_BATCH_SIZE):
+    """Iterate lazily over the entries of a file.
+
+    In contrast to :func:`get_entries`, the file is read and parsed
+    incrementally, so memory consumption does not depend on the size
+    of the file.
+
+    Parameters
+    ----------
+    filename : str
+        BibTeX file to parse; use "-" to read from standard input.
+
+    batch_size : int
+        Number of entries that are parsed at once
+
+    Returns
+    -------
+    iterable of dict
+        Processed entries; see :func:`get_entries`
+    """
+    if filename == "-":
+        yield from _iter_entries(sys.stdin, batch_size)
+        return
+
+    with open(filename, encoding="utf-8") as f:
+        yield from _iter_entries(f, batch_size)
@@ -1,28 +1,642 @@
 """Reindex all documents in the database.
 
-This script can be called at all times. It will perform a new indexing
-operation on all `.bib` files stored in the `data` directory.
+This script can be called at all times. It will update the database to
+reflect all `.bib` files stored in the `data` directory.
+
+The database keeps a manifest of the content hash of every file and the
+entries it produced. Only files whose content changed are parsed again,
+and entries that vanished, because their file was removed or no longer
+contains them, are deleted. Use `--full` to parse all files regardless
+of the manifest.
+
+Every parsed entry is checked for duplicates, i.e. entries by the same
+first author with the same DOI or with very similar titles and
+abstracts. Duplicates are reported, and, if `--merge-duplicates` is
+used, only the published or most recent entry of every group of
+duplicates is kept. Merged entries are marked in the manifest, so they
+are not indexed again while the surviving entry exists.
+
+Finally, the related documents of every parsed entry are calculated and
+stored in the database. Related documents of unchanged entries are not
+updated; use `--full` to update them as well.
+
+Parsing the files is pure CPU work, so it is distributed over a pool of
+processes. All parsed entries are written by a single writer within one
+transaction, resulting in a single commit for the whole reindexing run.
+
+With `--build-aside`, the live database is never written to. Instead, a
+new generation of the database is built in a sibling directory, such as
+`database.20240101T120000000000`, optionally compacted, and swapped in
+by atomically replacing the symbolic link `database`. Web workers open
+the new generation with their next request. Previous generations are
+removed once they have been retired for longer than a grace period, so
+that requests that are still being served from them can finish.
 """
 
 
 from dotenv import load_dotenv
 
-from donut.database import index_documents
+from donut.database import delete_entries
+from donut.database import find_duplicates
+from donut.database import get_entry
+from donut.database import get_identifiers
+from donut.database import index_entries
+from donut.database import update_related
+from donut.database import writable_database
 
+from donut.duplicates import is_preprint
+
+from donut.parse_bibtex import get_entries
+
+import argparse
+import collections
+import concurrent.futures
+import datetime
+import functools
 import glob
+import hashlib
+import json
 import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+import xapian
 
 load_dotenv()
 
+# Suffix of the directories of generations of a database.
+GENERATION_PATTERN = re.compile(r"\.\d{8}T\d{12}")
+
+# Number of seconds for which retired generations are kept.
+GRACE_PERIOD = int(os.getenv("GENERATION_GRACE_PERIOD", 3600))
+
+
+def _get_entries(filename, cache_dir=None):
+    """Get entries from file, reporting files that cannot be parsed.
+
+    A single malformed file should not prevent all other files from
+    being indexed, so errors are reported instead of being raised. In
+    this case, `None` is returned.
+    """
+    try:
+        return get_entries(filename, cache_dir)
+    except Exception as e:
+        print(f"Unable to parse {filename}: {e!r}", file=sys.stderr)
+        return None
+
+
+def parse_files(filenames, n_jobs=None, cache_dir=None):
+    """Parse files, potentially in parallel.
+
+    Parameters
+    ----------
+    filenames : list of str
+        Files to parse
+
+    n_jobs : int or None
+        Number of processes to use for parsing. If set to 1, parsing
+        happens in the current process. If `None`, uses all available
+        processors.
+
+    cache_dir : str or None
+        Directory for caching processed entries; see
+        :func:`donut.parse_bibtex.get_entries`
+
+    Returns
+    -------
+    iterable of tuples
+        (filename, entries) pairs, containing the processed entries of
+        each file, in the order of the files. If a file cannot be
+        parsed, its entries will be `None`.
+    """
+    parse = functools.partial(_get_entries, cache_dir=cache_dir)
+
+    if n_jobs == 1:
+        return zip(filenames, map(parse, filenames))
+
+    def _parse():
+        with concurrent.futures.ProcessPoolExecutor(n_jobs) as executor:
+            entries = executor.map(parse, filenames, chunksize=16)
+            yield from zip(filenames, entries)
+
+    return _parse()
+
+
+def hash_file(filename):
+    """Return hash of the contents of a file."""
+    with open(filename, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def _load_manifest(db):
+    """Load manifest of indexed files from database."""
+    return json.loads(db.get_metadata("manifest") or "{}")
+
+
+def _store_manifest(db, manifest):
+    """Store manifest of indexed files in database."""
+    db.set_metadata("manifest", json.dumps(manifest, sort_keys=True))
+
+
+def _rank_survivor(entry):
+    """Return key for choosing the entry that survives a merge.
+
+    Published entries take precedence over preprints, entries with a DOI
+    over entries without one, and later entries over earlier ones, since
+    the published version of a preprint usually appears later. The key
+    of the entry is only used to break ties.
+    """
+    raw = entry["raw"]
+
+    return (
+        not is_preprint(entry["type"], raw),
+        bool(entry.get("doi")),
+        raw.get("date", entry["year"]),
+        entry["id"],
+    )
+
+
+def _merge_duplicates(db, duplicates):
+    """Merge duplicates by deleting all but one entry of every group.
+
+    Pairs of duplicates that share an entry form a group, of which only
+    the highest-ranking entry is kept; see :func:`_rank_survivor`.
+
+    Returns
+    -------
+    dict
+        Keys of the surviving entries, indexed by the keys of the
+        deleted entries
+    """
+    parents = {}
+
+    def _find(identifier):
+        while parents.setdefault(identifier, identifier) != identifier:
+            identifier = parents[identifier]
+        return identifier
+
+    for duplicate in duplicates:
+        first, second = (_find(i) for i in duplicate["ids"])
+        parents[first] = second
+
+    groups = collections.defaultdict(list)
+    for identifier in parents:
+        groups[_find(identifier)].append(identifier)
+
+    merged = {}
+
+    for identifiers in groups.values():
+        entries = [get_entry(db, i) for i in identifiers]
+        entries = [entry for entry in entries if entry is not None]
+
+        if len(entries) < 2:
+            continue
+
+        survivor = max(entries, key=_rank_survivor)["id"]
+
+        for entry in entries:
+            if entry["id"] != survivor:
+                merged[entry["id"]] = survivor
+
+    delete_entries(db, merged)
+    return merged
+
+
+def _release_merged(manifest):
+    """Release entries whose surviving duplicate no longer exists.
+
+    Entries that have been merged into another entry are marked in the
+    manifest, so they are not indexed again. Once the surviving entry
+    vanishes, the mark is removed.
+
+    Returns
+    -------
+    set of str
+        Names of files with released entries; they have to be parsed
+        again to restore these entries.
+    """
+    current = {i for item in manifest.values() for i in item["ids"]}
+    released = set()
+
+    for name, item in manifest.items():
+        marks = item.pop("merged", {})
+        kept = {i: s for i, s in marks.items() if s in current}
+
+        if kept:
+            item["merged"] = kept
+
+        if len(kept) != len(marks):
+            released.add(name)
+
+    return released
+
+
+def reindex(
+    filenames,
+    database_dir,
+    n_jobs=None,
+    full=False,
+    cache_dir=None,
+    merge_duplicates=False,
+):
+    """Reindex files in a single transaction.
+
+    Parameters
+    ----------
+    filenames : list of str
+        Files to index
+
+    database_dir : str
+        Directory for database
+
+    n_jobs : int or None
+        Number of processes to use for parsing; see :func:`parse_files`
+
+    full : bool
+        If set, parses all files, regardless of whether they changed,
+        and deletes all entries that are not contained in any file.
+
+    cache_dir : str or None
+        Directory for caching processed entries; see
+        :func:`donut.parse_bibtex.get_entries`
+
+    merge_duplicates : bool
+        If set, only keeps one entry of every group of duplicates; see
+        :func:`_merge_duplicates`.
+
+    Returns
+    -------
+    dict
+        Summary of the update, containing the sorted identifiers of all
+        `added`, `updated`, `deleted`, and `merged` entries, the number
+        of `parsed` files, and the `duplicates` of all parsed entries;
+        see :func:`donut.database.find_duplicates`.
+    """
+    with writable_database(database_dir) as db:
+        manifest = _load_manifest(db)
+
+        # Entries known prior to the update; in a full reindex, every
+        # entry of the database is taken into account. This also takes
+        # care of databases that have been built without a manifest.
+        # Merged entries are not part of the database.
+        if full:
+            known = set(get_identifiers(db))
+        else:
+            known = {
+                i
+                for item in manifest.values()
+                for i in item["ids"]
+                if i not in item.get("merged", {})
+            }
+
+        hashes = {
+            os.path.basename(filename): hash_file(filename)
+            for filename in filenames
+        }
+
+        changed = [
+            filename
+            for filename in filenames
+            if full
+            or manifest.get(os.path.basename(filename), {}).get("hash")
+            != hashes[os.path.basename(filename)]
+        ]
+
+        # Files that are no longer present; their entries will be
+        # deleted unless they turn up in some other file.
+        for name in set(manifest) - set(hashes):
+            del manifest[name]
+
+        released = _release_merged(manifest)
+        changed += [
+            filename
+            for filename in filenames
+            if os.path.basename(filename) in released
+            and filename not in changed
+        ]
+
+        parsed = set()
+
+        def _record(results):
+            for filename, entries in results:
+                # Keep the previous state of files that cannot be parsed
+                # so that their entries are retained. Since their hash
+                # is not updated, they will be parsed again next time.
+                if entries is None:
+                    continue
+
+                name = os.path.basename(filename)
+                ids = [entry["id"] for entry in entries]
+
+                # Entries that have been merged into another entry are
+                # skipped, as long as their file still contains them.
+                marks = manifest.get(name, {}).get("merged", {})
+                marks = {i: s for i, s in marks.items() if i in ids}
+
+                manifest[name] = {"hash": hashes[name], "ids": ids}
+                if marks:
+                    manifest[name]["merged"] = marks
+
+                for entry in entries:
+                    if entry["id"] not in marks:
+                        parsed.add(entry["id"])
+                        yield entry
+
+        index_entries(db, _record(parse_files(changed, n_jobs, cache_dir)))
+
+        current = {i for item in manifest.values() for i in item["ids"]}
+
+        deleted = known - current
+        delete_entries(db, deleted)
+
+        duplicates = find_duplicates(db, sorted(parsed))
+
+        merged = {}
+        if merge_duplicates:
+            merged = _merge_duplicates(db, duplicates)
+
+        for item in manifest.values():
+            marks = {i: merged[i] for i in item["ids"] if i in merged}
+            if marks:
+                item.setdefault("merged", {}).update(marks)
+
+        parsed -= set(merged)
+        update_related(db, sorted(parsed))
+
+        _store_manifest(db, manifest)
+
+    return {
+        "added": sorted(parsed - known),
+        "updated": sorted(parsed & known),
+        "deleted": sorted(deleted),
+        "merged": sorted(merged),
+        "parsed": len(changed),
+        "duplicates": duplicates,
+    }
+
+
+def _make_generation_dir(database_dir):
+    """Return name of the directory for a new generation of a database."""
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return database_dir + now.strftime(".%Y%m%dT%H%M%S%f")
+
+
+def get_generations(database_dir):
+    """Return directories of all generations of a database."""
+    prefix = os.path.basename(database_dir)
+    parent = os.path.dirname(os.path.abspath(database_dir))
+
+    return sorted(
+        os.path.join(parent, name)
+        for name in os.listdir(parent)
+        if name.startswith(prefix)
+        and GENERATION_PATTERN.fullmatch(name[len(prefix) :])
+        and os.path.isdir(os.path.join(parent, name))
+    )
+
+
+def swap_generation(database_dir, generation_dir):
+    """Make generation the current one by replacing a symbolic link.
+
+    If the database directory is not a symbolic link yet, it is turned
+    into a generation itself first. This is the only time at which the
+    database is briefly unavailable for opening it.
+
+    Returns
+    -------
+    str or None
+        Directory of the retired generation, if any
+    """
+    previous = None
+
+    if os.path.islink(database_dir):
+        previous = os.path.realpath(database_dir)
+    elif os.path.isdir(database_dir):
+        previous = _make_generation_dir(database_dir)
+        os.rename(database_dir, previous)
+
+    # The link is relative, so the database can still be moved around
+    # as a whole.
+    link = database_dir + ".link"
+    if os.path.lexists(link):
+        os.remove(link)
+
+    os.symlink(os.path.basename(generation_dir), link)
+    os.replace(link, database_dir)
+
+    # The modification time of a retired generation denotes the time of
+    # its retirement; see `remove_generations`.
+    if previous is not None:
+        os.utime(previous)
+
+    return previous
+
+
+def remove_generations(database_dir, grace_period=GRACE_PERIOD):
+    """Remove generations that have been retired for some time.
+
+    Returns
+    -------
+    list of str
+        Directories of removed generations
+    """
+    current = os.path.realpath(database_dir)
+    removed = []
+
+    for generation_dir in get_generations(database_dir):
+        if os.path.realpath(generation_dir) == current:
+            continue
+
+        if time.time() - os.path.getmtime(generation_dir) >= grace_period:
+            shutil.rmtree(generation_dir, ignore_errors=True)
+            removed.append(generation_dir)
+
+    return removed
+
+
+def reindex_aside(
+    filenames,
+    database_dir,
+    n_jobs=None,
+    full=False,
+    cache_dir=None,
+    merge_duplicates=False,
+    compact=False,
+    grace_period=GRACE_PERIOD,
+):
+    """Reindex files into a new generation of the database.
+
+    The current generation is copied unless `full` is set, updated via
+    :func:`reindex`, optionally compacted, and swapped in. Afterwards,
+    old generations are removed; see :func:`remove_generations`.
+
+    Parameters
+    ----------
+    compact : bool
+        If set, compacts the new generation before swapping it in.
+
+    grace_period : int
+        Number of seconds for which retired generations are kept
+
+    Returns
+    -------
+    dict
+        Summary of the update; see :func:`reindex`. In addition, the
+        summary contains the directory of the new `generation` as well
+        as the list of `removed` generations.
+
+    Notes
+    -----
+    All other parameters are passed to :func:`reindex`.
+    """
+    parent = os.path.dirname(os.path.abspath(database_dir))
+    build_dir = tempfile.mkdtemp(
+        prefix=os.path.basename(database_dir) + ".build-", dir=parent
+    )
+
+    generation_dir = _make_generation_dir(database_dir)
+
+    try:
+        if not full and os.path.exists(database_dir):
+            shutil.copytree(
+                os.path.realpath(database_dir), build_dir, dirs_exist_ok=True
+            )
+
+        summary = reindex(
+            filenames, build_dir, n_jobs, full, cache_dir, merge_duplicates
+        )
+
+        if compact:
+            xapian.Database(build_dir).compact(generation_dir)
+            shutil.rmtree(build_dir)
+        else:
+            os.rename(build_dir, generation_dir)
+    except BaseException:
+        shutil.rmtree(build_dir, ignore_errors=True)
+        shutil.rmtree(generation_dir, ignore_errors=True)
+        raise
+
+    swap_generation(database_dir, generation_dir)
+
+    summary["generation"] = generation_dir
+    summary["removed"] = remove_generations(database_dir, grace_period)
+
+    return summary
+
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=None,
+        help="Number of parsing processes (default: number of processors)",
+    )
+    parser.add_argument(
+        "-f",
+        "--full",
+        action="store_true",
+        help="Parse all files instead of only the changed ones",
+    )
+
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Do not use cached entries of unchanged files",
+    )
+    parser.add_argument(
+        "--merge-duplicates",
+        action="store_true",
+        help="Only keep one entry of every pair of duplicates",
+    )
+    parser.add_argument(
+        "-a",
+        "--build-aside",
+        action="store_true",
+        help="Build a new generation of the database and swap it in",
+    )
+    parser.add_argument(
+        "--compact",
+        action="store_true",
+        help="Compact the new generation (implies --build-aside)",
+    )
+    parser.add_argument(
+        "--grace-period",
+        type=int,
+        default=GRACE_PERIOD,
+        help="Seconds for which retired generations are kept",
+    )
+
+    args = parser.parse_args()
+
     DATA_DIR = os.getenv("DATA_DIR", "data")
     DATABASE_DIR = os.getenv("DATABASE_DIR", "database")
+    CACHE_DIR = os.getenv("CACHE_DIR", ".cache")
 
     assert DATA_DIR is not None
     assert DATABASE_DIR is not None
 
-    filenames = glob.glob(os.path.join(DATA_DIR, "*.bib"))
+    cache_dir = None if args.no_cache else os.path.join(CACHE_DIR, "entries")
+
+    filenames = sorted(glob.glob(os.path.join(DATA_DIR, "*.bib")))
+
+    start = time.perf_counter()
+
+    if args.build_aside or args.compact:
+        summary = reindex_aside(
+            filenames,
+            DATABASE_DIR,
+            args.jobs,
+            args.full,
+            cache_dir,
+            args.merge_duplicates,
+            args.compact,
+            args.grace_period,
+        )
+    else:
+        summary = reindex(
+            filenames,
+            DATABASE_DIR,
+            args.jobs,
+            args.full,
+            cache_dir,
+            args.merge_duplicates,
+        )
+
+    duration = time.perf_counter() - start
+
+    for action in ["added", "updated", "deleted", "merged"]:
+        identifiers = summary[action]
+        print(f"{action.title()} {len(identifiers)} entries")
+
+        for identifier in identifiers:
+            print("  ", identifier)
+
+    duplicates = summary["duplicates"]
+    print(f"Found {len(duplicates)} potential duplicates")
+
+    for duplicate in duplicates:
+        first, second = duplicate["ids"]
+        print(
+            "  ",
+            first,
+            "~",
+            second,
+            f"({duplicate['reason']}, {duplicate['similarity']:.2f})",
+        )
+
+    if "generation" in summary:
+        print(f"Swapped in generation {summary['generation']}")
+
+        for generation_dir in summary["removed"]:
+            print(f"Removed generation {generation_dir}")
+
+    n_entries = len(summary["added"]) + len(summary["updated"])
 
-    for filename in filenames:
-        index_documents(filename, DATABASE_DIR)
+    print(
+        f"Parsed {summary['parsed']} of {len(filenames)} files "
+        f"in {duration:.2f}s ({n_entries / duration:.1f} entries/s)"
+    )
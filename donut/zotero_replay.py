@@ -0,0 +1,232 @@
+"""Stand-in server for the Zotero API.
+
+This script serves recorded responses of the Zotero API, making it
+possible to test the synchronisation of `donut.zotero_to_bib` without
+network access or an API key. Point the converter to the server by
+setting `ZOTERO_ENDPOINT`, e.g. to `http://localhost:8023`.
+
+Every recording is stored as a JSON file in the recordings directory,
+containing the `path` and `query` of the request as well as the
+`status`, `headers`, and `body` of the response. Requests are matched
+by their path and query, ignoring the locale. If several recordings
+match the same request, they are served in the order of their file
+names, and the last one is repeated afterwards. This makes it possible
+to replay consecutive synchronisations of a changing library.
+
+Use `--record` to forward all requests to the Zotero API instead, and
+to store its responses as new recordings. Credentials are forwarded,
+but never stored.
+"""
+
+import argparse
+import collections
+import glob
+import http.server
+import json
+import os
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+
+# Location of the Zotero API, used when recording responses.
+UPSTREAM = "https://api.zotero.org"
+
+# Query parameters that do not affect the response.
+IGNORED_PARAMETERS = {"locale"}
+
+# Headers of requests that are forwarded to the Zotero API, and headers
+# of responses that are recorded. Other headers are not required by the
+# client.
+REQUEST_HEADERS = ["Authorization", "Zotero-API-Key", "Zotero-API-Version"]
+RESPONSE_HEADERS = [
+    "Content-Type",
+    "Last-Modified-Version",
+    "Link",
+    "Total-Results",
+]
+
+
+def _get_key(path, query):
+    """Return key for matching a request to its recordings."""
+    query = {
+        name: value
+        for name, value in query.items()
+        if name not in IGNORED_PARAMETERS
+    }
+
+    return path, tuple(sorted(query.items()))
+
+
+def load_recordings(directory):
+    """Load recordings from a directory.
+
+    Returns
+    -------
+    dict
+        Recorded responses for every request key, in the order in which
+        they will be served
+    """
+    recordings = collections.defaultdict(list)
+
+    for filename in sorted(glob.glob(os.path.join(directory, "*.json"))):
+        with open(filename) as f:
+            recording = json.load(f)
+
+        key = _get_key(recording["path"], recording.get("query", {}))
+        recordings[key].append(recording)
+
+    return recordings
+
+
+def _encode_body(recording):
+    """Encode body of a recorded response."""
+    body = recording.get("body", "")
+    content_type = recording.get("headers", {}).get("Content-Type", "")
+
+    if content_type.startswith("application/json"):
+        body = json.dumps(body, ensure_ascii=False)
+
+    return body.encode("utf-8")
+
+
+def _decode_body(data, content_type):
+    """Decode body of a response such that it can be recorded."""
+    body = data.decode("utf-8")
+
+    if content_type.startswith("application/json"):
+        body = json.loads(body)
+
+    return body
+
+
+def make_handler(directory, record=False):
+    """Create request handler for replaying or recording responses.
+
+    Parameters
+    ----------
+    directory : str
+        Directory of recordings
+
+    record : bool
+        If set, forwards requests to the Zotero API and stores their
+        responses instead of replaying recorded ones.
+    """
+    recordings = load_recordings(directory)
+    served = collections.Counter()
+    lock = threading.Lock()
+
+    def _replay(path, query):
+        key = _get_key(path, query)
+
+        with lock:
+            if key not in recordings:
+                return None
+
+            index = min(served[key], len(recordings[key]) - 1)
+            served[key] += 1
+
+        return recordings[key][index]
+
+    def _record(path, query, headers):
+        url = UPSTREAM + path
+        if query:
+            url += "?" + urllib.parse.urlencode(query)
+
+        request = urllib.request.Request(url, headers=headers)
+
+        try:
+            with urllib.request.urlopen(request) as response:
+                status, data = response.status, response.read()
+                response_headers = response.headers
+        except urllib.error.HTTPError as error:
+            status, data = error.code, error.read()
+            response_headers = error.headers
+
+        content_type = response_headers.get("Content-Type", "")
+        recording = {
+            "path": path,
+            "query": {
+                name: value
+                for name, value in query.items()
+                if name not in IGNORED_PARAMETERS
+            },
+            "status": status,
+            "headers": {
+                name: response_headers[name]
+                for name in RESPONSE_HEADERS
+                if name in response_headers
+            },
+            "body": _decode_body(data, content_type),
+        }
+
+        with lock:
+            index = sum(len(values) for values in recordings.values())
+            filename = os.path.join(directory, f"{index:03d}.json")
+
+            with open(filename, "w") as f:
+                json.dump(recording, f, indent=2, ensure_ascii=False)
+                f.write("\n")
+
+            recordings[_get_key(path, query)].append(recording)
+
+        return recording
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urllib.parse.urlsplit(self.path)
+            query = dict(urllib.parse.parse_qsl(url.query))
+
+            if record:
+                headers = {
+                    name: self.headers[name]
+                    for name in REQUEST_HEADERS
+                    if name in self.headers
+                }
+                recording = _record(url.path, query, headers)
+            else:
+                recording = _replay(url.path, query)
+
+            if recording is None:
+                self.send_error(404, "No recording for this request")
+                return
+
+            body = _encode_body(recording)
+
+            self.send_response(recording.get("status", 200))
+            for name, value in recording.get("headers", {}).items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+
+            self.wfile.write(body)
+
+    return Handler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("directory", help="Directory of recordings")
+    parser.add_argument(
+        "-p",
+        "--port",
+        type=int,
+        default=8023,
+        help="Port to listen on",
+    )
+    parser.add_argument(
+        "-r",
+        "--record",
+        action="store_true",
+        help="Record responses of the Zotero API instead of replaying them",
+    )
+
+    args = parser.parse_args()
+
+    os.makedirs(args.directory, exist_ok=True)
+
+    handler = make_handler(args.directory, args.record)
+    server = http.server.ThreadingHTTPServer(("localhost", args.port), handler)
+
+    print(f"Serving {args.directory} on http://localhost:{args.port}")
+    server.serve_forever()
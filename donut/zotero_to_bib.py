@@ -3,37 +3,333 @@
 The purpose of this script is to query the online Zotero database,
 download all items, and convert them to `.bib` files, which can be
 stored and managed via `git`.
+
+Synchronisation is incremental: the version of the library at the last
+run is stored together with the file of every item, so only items that
+have been modified since then are downloaded. Files of items that have
+been deleted or moved to the trash are removed, and files are only
+written if their content changed. The keys of all changed entries are
+printed, one per line. Use `--full` to download all items again. If
+all items are downloaded, all `.bib` files that do not belong to any of
+them are removed.
+
+Items sharing the same citation key are disambiguated like the export
+of Zotero does, i.e. by appending `-1`, `-2`, etc. to the key. Every
+item keeps its file as long as its citation key does not change.
+
+Set `ZOTERO_ENDPOINT` to use a different server, such as a local server
+that replays recorded responses of the Zotero API; see
+`donut.zotero_replay`.
 """
 
 from dotenv import load_dotenv
 from pyzotero import zotero
 
+import argparse
 import bibtexparser
+import glob
+import itertools
+import json
 import os
+import sys
 
 load_dotenv()
 
 
+def load_state(filename):
+    """Load state of the last synchronisation.
+
+    Returns
+    -------
+    dict
+        State, containing the library `version`, the mapping from item
+        keys to the names of their files (`files`), and the reverse
+        mapping from file names to item keys (`items`). If no state has
+        been stored yet, the version is zero.
+    """
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"version": 0, "files": {}, "items": {}}
+
+
+def store_state(filename, state):
+    """Store state of the synchronisation."""
+    with open(filename, "w") as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+def get_candidates(identifier):
+    """Return file names for an entry, in the order of preference.
+
+    The first name is based on the citation key of the entry; further
+    names disambiguate entries with the same key, just like the export
+    of Zotero does.
+    """
+    yield identifier + ".bib"
+
+    for index in itertools.count(1):
+        yield f"{identifier}-{index}.bib"
+
+
+def _is_candidate(name, identifier):
+    """Check whether a file name is a candidate for an entry."""
+    if name == identifier + ".bib":
+        return True
+
+    stem, suffix = os.path.splitext(name)
+    prefix, _, index = stem.rpartition("-")
+
+    return suffix == ".bib" and prefix == identifier and index.isdigit()
+
+
+def format_entry(entry):
+    """Format single BibTeX entry as it will be stored in a file."""
+    database = bibtexparser.bibdatabase.BibDatabase()
+    database.entries = [entry]
+
+    return bibtexparser.dumps(database)
+
+
+def write_file(filename, content):
+    """Write file if its content changed.
+
+    Returns
+    -------
+    bool
+        `True` if the file has been written
+    """
+    try:
+        with open(filename) as f:
+            if f.read() == content:
+                return False
+    except FileNotFoundError:
+        pass
+
+    with open(filename, "w") as f:
+        f.write(content)
+
+    return True
+
+
+def remove_file(filename):
+    """Remove file if it exists.
+
+    Returns
+    -------
+    bool
+        `True` if the file has been removed
+    """
+    try:
+        os.remove(filename)
+    except FileNotFoundError:
+        return False
+
+    return True
+
+
+def _release(state, key):
+    """Release the file of an item and return its name, if any."""
+    name = state["files"].pop(key, None)
+
+    if name is not None and state["items"].get(name) == key:
+        del state["items"][name]
+
+    return name
+
+
+def _assign(state, key, entry, data_dir):
+    """Assign file to an item and return its name and formatted entry.
+
+    An item keeps its current file if it is still a candidate for its
+    citation key. Otherwise, the first candidate that does not belong
+    to another item is used. Files that already contain the entry are
+    preferred, so that files of a previous export are reused.
+    """
+    identifier = entry["ID"].strip().lower()
+
+    def _format(name):
+        suffix = os.path.splitext(name)[0][len(identifier) :]
+        return format_entry(dict(entry, ID=entry["ID"].strip() + suffix))
+
+    previous = state["files"].get(key)
+    if previous is not None and _is_candidate(previous, identifier):
+        return previous, _format(previous)
+
+    available = []
+
+    for name in get_candidates(identifier):
+        if state["items"].get(name) is not None:
+            continue
+
+        available.append(name)
+        filename = os.path.join(data_dir, name)
+
+        if not os.path.exists(filename):
+            break
+
+        content = _format(name)
+
+        with open(filename) as f:
+            if f.read() == content:
+                return name, content
+
+    # The last candidate does not exist yet, so the first one is either
+    # free or only contains an outdated entry without an owner.
+    return available[0], _format(available[0])
+
+
+def sync(zot, data_dir, state, full=False):
+    """Synchronise `.bib` files with a Zotero library.
+
+    Parameters
+    ----------
+    zot : zotero.Zotero
+        Library to synchronise with
+
+    data_dir : str
+        Directory of `.bib` files
+
+    state : dict
+        State of the last synchronisation; see :func:`load_state`. The
+        state will be updated in place.
+
+    full : bool
+        If set, downloads all items instead of only the modified ones.
+        Whenever all items are downloaded, which is also the case for
+        the first synchronisation, files that do not belong to any item
+        are removed.
+
+    Returns
+    -------
+    dict
+        Summary of the synchronisation, containing the sorted keys of
+        all `written` and `removed` entries, and the number of items
+        that have been `fetched`.
+    """
+    since = 0 if full else state["version"]
+
+    # The version is queried *before* retrieving items, so items that
+    # are modified in the meantime will be retrieved again next time.
+    version = zot.last_modified_version()
+
+    items = zot.everything(zot.items(since=since, include="biblatex"))
+
+    entries = {}
+
+    for item in items:
+        # Notes and attachments cannot be exported.
+        if not item.get("biblatex", "").strip():
+            continue
+
+        # Use the same settings as `pyzotero` for BibTeX responses, so
+        # that entries of non-standard types are retained.
+        parser = bibtexparser.bparser.BibTexParser(
+            common_strings=True, ignore_nonstandard_types=False
+        )
+        database = bibtexparser.loads(item["biblatex"], parser=parser)
+
+        # Every item is exported as a single entry.
+        if database.entries:
+            entries[item["key"]] = database.entries[0]
+
+    gone = set()
+    if since > 0:
+        gone.update(zot.deleted(since=since)["items"])
+        gone.update(zot.trash(since=since, format="versions", limit=None))
+    else:
+        gone.update(set(state["files"]) - set(entries))
+
+    # Files of removed items, and of items whose citation key changed,
+    # are released first, so that their names can be reused.
+    released = {_release(state, key) for key in gone}
+
+    for key, entry in entries.items():
+        previous = state["files"].get(key)
+        identifier = entry["ID"].strip().lower()
+
+        if previous is not None and not _is_candidate(previous, identifier):
+            released.add(_release(state, key))
+
+    written = set()
+
+    for key in sorted(entries):
+        name, content = _assign(state, key, entries[key], data_dir)
+
+        state["files"][key] = name
+        state["items"][name] = key
+
+        if write_file(os.path.join(data_dir, name), content):
+            written.add(os.path.splitext(name)[0])
+
+    # A released file may have been assigned to another item.
+    unused = {name for name in released if name is not None}
+
+    # Without a previous state, all items have been downloaded, so any
+    # other file is a leftover, e.g. of an earlier export.
+    if since == 0:
+        unused.update(
+            os.path.basename(filename)
+            for filename in glob.glob(os.path.join(data_dir, "*.bib"))
+        )
+
+    removed = set()
+
+    for name in unused - set(state["items"]):
+        if remove_file(os.path.join(data_dir, name)):
+            removed.add(os.path.splitext(name)[0])
+
+    state["version"] = version
+
+    return {
+        "written": sorted(written),
+        "removed": sorted(removed),
+        "fetched": len(items),
+    }
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "-f",
+        "--full",
+        action="store_true",
+        help="Download all items instead of only the modified ones",
+    )
+
+    args = parser.parse_args()
+
     API_KEY = os.getenv("ZOTERO_API_KEY")
     DATA_DIR = os.getenv("DATA_DIR", "data")
+    LIBRARY_ID = os.getenv("ZOTERO_LIBRARY_ID", "2425412")
+    ENDPOINT = os.getenv("ZOTERO_ENDPOINT")
+    STATE_FILE = os.getenv(
+        "ZOTERO_STATE_FILE", os.path.join(DATA_DIR, ".zotero.json")
+    )
 
     assert API_KEY is not None
     assert DATA_DIR is not None
 
-    zot = zotero.Zotero(2425412, "group", API_KEY)
-    zot.add_parameters(format="biblatex")
+    zot = zotero.Zotero(LIBRARY_ID, "group", API_KEY)
 
-    database = zot.everything(zot.items())
+    if ENDPOINT is not None:
+        zot.endpoint = ENDPOINT.rstrip("/")
 
-    for entry in database.entries:
-        database_ = bibtexparser.bibdatabase.BibDatabase()
-        database_.entries = [entry]
+    state = load_state(STATE_FILE)
+    previous_version = state["version"]
 
-        assert "ID" in entry
+    summary = sync(zot, DATA_DIR, state, args.full)
+    store_state(STATE_FILE, state)
 
-        filename = entry["ID"].strip().lower()
-        filename = os.path.join(DATA_DIR, filename + ".bib")
+    for identifier in summary["written"] + summary["removed"]:
+        print(identifier)
 
-        with open(filename, "w") as f:
-            bibtexparser.dump(database_, f)
+    print(
+        f"Synchronised library version {previous_version} to "
+        f"{state['version']}: fetched {summary['fetched']} items, wrote "
+        f"{len(summary['written'])} files, removed "
+        f"{len(summary['removed'])} files",
+        file=sys.stderr,
+    )